@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+""" Bootstrap confidence intervals for crude and standardised rates
+
+People in the by year classification (output/classification.csv) are
+resampled with replacement, optionally within strata (year first seen
+and/or DHB). People who contribute the same counts to the same cells are
+only kept once with a multiplicity, and a replicate draws how many of each
+from a multinomial, so people are never materialised. Each replicate's
+counts go through the rate engine (rates.py) to give the rates.
+"""
+from collections import defaultdict, OrderedDict
+import csv
+import multiprocessing
+import numpy
+
+import counts
+import rates
+
+# Same seed as the statistical code (R/model-base.R)
+SEED = 123
+
+MEASURES = ('prevalence','incidence')
+
+
+class PersonTypes:
+    """ People grouped by the cells they contribute to, with the number of each """
+
+    def __init__(self, fname='output/classification.csv',
+                 classifications=('Very probable','Probable'), strata=()):
+
+        self.strata = strata
+
+        people = OrderedDict()
+
+        with open(fname, 'rU') as f:
+            for row in csv.DictReader(f):
+                try:
+                    person = people[row['nhi']]
+                except KeyError:
+                    stratum = tuple(row['year_first_seen'] if name == 'year' else row[name]
+                                    for name in strata)
+                    person = people[row['nhi']] = {'stratum':stratum, 'cells':[]}
+
+                if row['classification'] not in classifications:
+                    continue
+
+                age = counts.age_band(float(row['age']), *counts.AGE_SCHEMES['agecut5_85'])
+                cell = (row['year'], row['sex'], row['ethnicity'], row['dhb'], age)
+                person['cells'].append(('prevalence', cell))
+                if row['year_in_data'] == '1':
+                    person['cells'].append(('incidence', cell))
+
+        # Labels of each axis of the counts tables
+        self.names = ('year','sex','ethnicity','dhb','age')
+        self.labels = [sorted(set(cell[i] for person in people.itervalues()
+                                  for measure, cell in person['cells']))
+                       for i in xrange(len(self.names))]
+        index = [dict((label, j) for j, label in enumerate(labels)) for labels in self.labels]
+        shape = [len(labels) for labels in self.labels]
+
+        # Group identical people
+        multiplicity = defaultdict(int)
+        for person in people.itervalues():
+            multiplicity[(person['stratum'], tuple(sorted(person['cells'])))] += 1
+
+        types = sorted(multiplicity.keys())
+        self.multiplicity = numpy.array([multiplicity[key] for key in types])
+        strata_index = dict((stratum, j) for j, stratum in enumerate(sorted(set(key[0] for key in types))))
+        self.stratum_of_type = numpy.array([strata_index[key[0]] for key in types], dtype=int)
+        self.nstrata = len(strata_index)
+
+        # Sparse contributions of each type: (type, flat cell index) for each measure
+        self.contributions = dict()
+        for measure in MEASURES:
+            type_index = []
+            cell_index = []
+            for k, (stratum, cells) in enumerate(types):
+                for cell_measure, cell in cells:
+                    if cell_measure == measure:
+                        type_index.append(k)
+                        cell_index.append(numpy.ravel_multi_index(
+                            [index[i][label] for i, label in enumerate(cell)], shape))
+            self.contributions[measure] = (numpy.array(type_index, dtype=int),
+                                           numpy.array(cell_index, dtype=int))
+        self.shape = shape
+
+    def resample(self, random):
+        """ Number of each type of person in a resample, keeping the number in each stratum """
+
+        sampled = numpy.zeros(len(self.multiplicity), dtype=int)
+        for stratum in xrange(self.nstrata):
+            members = numpy.flatnonzero(self.stratum_of_type == stratum)
+            n = self.multiplicity[members]
+            sampled[members] = random.multinomial(n.sum(), n/float(n.sum()))
+        return sampled
+
+    def counts(self, measure, number=None):
+        """ Counts table for a measure, from the number of each type (original data if None) """
+
+        if number is None:
+            number = self.multiplicity
+
+        type_index, cell_index = self.contributions[measure]
+        values = numpy.bincount(cell_index, weights=number[type_index],
+                                minlength=int(numpy.prod(self.shape)))
+        return rates.Table(self.names, self.labels, values.reshape(self.shape))
+
+
+# State shared with the worker processes
+worker = dict()
+
+def init_worker(people, engine, arguments):
+    worker['people'] = people
+    worker['engine'] = engine
+    worker['arguments'] = arguments
+
+def run_replicates(replicates):
+    """ Crude and standardised rates for each replicate number """
+
+    people = worker['people']
+    engine = worker['engine']
+    arguments = worker['arguments']
+
+    results = []
+    for replicate in replicates:
+        # Each replicate has its own seed, so results don't depend on the number of processes
+        random = numpy.random.RandomState([arguments['seed'], replicate])
+        number = people.resample(random)
+        result = engine.rates(people.counts(arguments['measure'], number), arguments['by'],
+                              arguments['population'], arguments['measure'], arguments['standard'])
+        results.append((result['crude'], result['standardised']))
+    return results
+
+
+def intervals(people, engine, by, population='year_sex_age', measure='prevalence',
+              standard='nz_standard_pop', replicates=1000, alpha=0.05, seed=SEED,
+              processes=None):
+    """ Rates with bootstrap percentile intervals
+
+    Returns the rates for the original data (see RateEngine.rates) with the
+    lower and upper limits of the crude and standardised rates added.
+    """
+
+    arguments = {'by':by, 'population':population, 'measure':measure,
+                 'standard':standard, 'seed':seed}
+
+    result = engine.rates(people.counts(measure), by, population, measure, standard)
+
+    batches = [range(i, min(i+50, replicates)) for i in xrange(0, replicates, 50)]
+
+    if processes == 1:
+        init_worker(people, engine, arguments)
+        replicated = map(run_replicates, batches)
+    else:
+        pool = multiprocessing.Pool(processes, init_worker, (people, engine, arguments))
+        replicated = pool.map(run_replicates, batches)
+        pool.close()
+        pool.join()
+
+    replicated = [rate for batch in replicated for rate in batch]
+
+    for i, name in enumerate(('crude','standardised')):
+        values = numpy.array([rate[i] for rate in replicated])
+        result[name+'_lower'] = numpy.nanpercentile(values, 100*alpha/2, axis=0)
+        result[name+'_upper'] = numpy.nanpercentile(values, 100*(1-alpha/2), axis=0)
+
+    return result
+
+
+def write_intervals(fname, results):
+
+    names = ['year','sex','ethnicity','dhb']
+    fields = ['measure','population','standard'] + names + \
+             ['cases','crude','crude_lower','crude_upper',
+              'standardised','standardised_lower','standardised_upper']
+
+    with open(fname, "w") as f:
+        writer = csv.DictWriter(f, fieldnames=fields, restval='All')
+        writer.writeheader()
+
+        for info, result in results:
+            for index in numpy.ndindex(*result['crude'].shape):
+                row = dict(info)
+                for i, name in enumerate(result['by']):
+                    row[name] = result['labels'][i][index[i]]
+                row['cases'] = "{:.1f}".format(result['cases'][index])
+                for field in fields[-6:]:
+                    row[field] = "{:.2f}".format(result[field][index])
+                writer.writerow(row)
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Bootstrap intervals for DHB and ethnicity rates')
+    parser.add_argument('--replicates', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--stratify', nargs='*', default=['year','dhb'], choices=['year','dhb'],
+                        help='Resample within year first seen and/or DHB')
+    args = parser.parse_args()
+
+    engine = rates.RateEngine()
+    people = PersonTypes(strata=tuple(args.stratify))
+
+    results = []
+    for measure in MEASURES:
+        for by, population in ((('ethnicity',), 'ethnicity_sex_age_2013'),
+                               (('dhb',), 'dhb_sex_age_2013')):
+            result = intervals(people, engine, by, population, measure,
+                               replicates=args.replicates, seed=args.seed,
+                               processes=args.processes)
+            results.append(({'measure':measure, 'population':population, 'standard':'nz_standard_pop'},
+                            result))
+
+    write_intervals('output/rate_intervals.csv', results)
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+import numpy
+
+# Conditions identified from mortality and admission ICD codes.
+# Each condition is a list of ICD code prefixes, or ranges of prefixes
+# such as 'G30-G32' (G30, G31 and G32). Dots are ignored, as the NMDS codes
+# are undotted (F02.3 is F023)
+CONDITIONS = OrderedDict([
+        ('PD', ('G20',)), # Parkinson's disease
+        ('Secondary parkinsonism', ('G21',)),
+        ('Basal ganglia degeneration', ('G23',)), # PSP, MSA-P, Striatonigral degeneration
+        ('Other degenerative', ('G31',)), # Includes Lewy body disease
+        ('PD dementia', ('F02.3',)), # Dementia in Parkinson's disease
+    ])
+
+def expand_range(spec):
+    """ Expand an ICD prefix range such as 'G30-G32' into its prefixes """
+
+    if '-' not in spec:
+        return [spec]
+
+    first, last = spec.split('-')
+
+    # Split into the common stem and the trailing numbers
+    stem = first.rstrip('0123456789')
+    if not last.startswith(stem) or len(first) != len(last):
+        raise ValueError("Unable to expand ICD range {}".format(spec))
+
+    width = len(first) - len(stem)
+    return ["{}{:0{}d}".format(stem, i, width)
+            for i in xrange(int(first[len(stem):]), int(last[len(stem):])+1)]
+
+
+class ConditionMatcher:
+    """ Prefix trie matching ICD codes against a registry of conditions """
+
+    def __init__(self, conditions=CONDITIONS):
+
+        self.conditions = conditions
+        self.trie = dict()
+        self.matched = dict()
+
+        for name in conditions:
+            for spec in conditions[name]:
+                for prefix in expand_range(spec):
+                    node = self.trie
+                    for char in prefix.replace('.', ''):
+                        node = node.setdefault(char, dict())
+                    node.setdefault(None, []).append(name)
+
+    def match(self, code):
+        """ Return a tuple of the conditions whose prefixes match the code """
+
+        # Codes repeat a lot so keep the result for each distinct code
+        try:
+            return self.matched[code]
+        except KeyError:
+            pass
+
+        names = []
+        node = self.trie
+        for char in code.strip().replace('.', ''):
+            try:
+                node = node[char]
+            except KeyError:
+                break
+            names.extend(node.get(None, ()))
+
+        names = tuple(name for name in self.conditions if name in names)
+        self.matched[code] = names
+        return names
+
+    def match_array(self, codes):
+        """ Boolean arrays, one per condition, of which codes in a numpy array match
+
+        Codes match with or without the dot:
+
+        >>> hits = ConditionMatcher().match_array(numpy.array(['F023', 'F02.3', 'G20']))
+        >>> hits['PD dementia'].tolist()
+        [True, True, False]
+        """
+
+        uniq, inverse = numpy.unique(codes, return_inverse=True)
+        matches = [self.match(code) for code in uniq.tolist()]
+
+        hits = OrderedDict()
+        for name in self.conditions:
+            matched = numpy.array([name in names for names in matches], dtype=bool)
+            hits[name] = matched[inverse].reshape(codes.shape)
+        return hits
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
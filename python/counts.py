@@ -0,0 +1,67 @@
+from collections import defaultdict, OrderedDict
+import math
+import csv
+
+# Age band schemes used by the statistical code (R/model-base.R)
+# name: (lowest band, band width, open-ended top band)
+AGE_SCHEMES = OrderedDict([
+        ('agecut5_100', (20, 5, 100)),
+        ('agecut5_95', (20, 5, 95)),
+        ('agecut5_90', (20, 5, 90)),
+        ('agecut5_85', (20, 5, 85)),
+        ('agecut10_80', (20, 10, 80)),
+    ])
+
+def age_band(age, first, width, top):
+    """ Label of the age band containing age, as given by R's cut()
+
+    Bands are closed on the right, e.g. for 5 year bands from 20 the first
+    is (0,25] labelled 20, then (25,30] labelled 25, up to (top,200] labelled 'top+'
+    """
+
+    if age <= 0 or age > 200:
+        return 'NA'
+
+    band = first + max(int(math.ceil((age - first)/float(width))) - 1, 0)*width
+
+    if band >= top:
+        return '{}+'.format(top)
+    else:
+        return str(band)
+
+
+class ClassificationCounts:
+    """ Counts of people by year, classification, ethnicity, sex, DHB and age band
+
+    Prevalence counts everyone in each year they appear, incidence only counts
+    people in their first year in the data. All age band schemes are included
+    as columns of the same row, as they are all determined by the finest one.
+    """
+
+    dimensions = ['year','classification','ethnicity','sex','dhb']
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+
+    def add(self, data):
+        """ Add a row of the by year classification """
+
+        age = float(data['age'])
+        key = tuple(data[dimension] for dimension in self.dimensions) + \
+              tuple(age_band(age, *AGE_SCHEMES[scheme]) for scheme in AGE_SCHEMES)
+
+        self.counts[('prevalence',) + key] += 1
+
+        if data['year_in_data'] == 1:
+            self.counts[('incidence',) + key] += 1
+
+    def write(self, fname):
+
+        fields = ['measure'] + self.dimensions + AGE_SCHEMES.keys() + ['n']
+
+        with open(fname, "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(fields)
+
+            for key in sorted(self.counts.keys()):
+                writer.writerow(list(key) + [self.counts[key]])
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+""" Medication coverage of the cohort on any date
+
+Each dispensing covers the days from its date for its days supply. A
+person's dispensings are merged into disjoint intervals per drug group (and
+for any anti-parkinsonian medication), in the same way days on L-dopa are
+counted by process.py. The intervals of the whole cohort are kept as arrays,
+so the number of people covered on a date, or every day over a period, is a
+few numpy operations.
+
+    python coverage.py 2013-07-01 --by group sex dhb
+    python coverage.py --series 2006-01-01 2015-12-31 --by group
+"""
+from collections import defaultdict, OrderedDict
+import argparse
+import csv
+import datetime
+import numpy
+
+import counts
+
+ANY = 'Any'
+
+# Person fields that point counts and series can be split by, as well as group and age
+PERSON_FIELDS = ('sex','ethnicity','dhb','classification')
+
+day_cache = dict()
+
+def parse_day(date):
+    """ Day number (proleptic ordinal) of a dd/mm/yyyy date """
+
+    try:
+        return day_cache[date]
+    except KeyError:
+        day, month, year = date.split('/')
+        day_cache[date] = datetime.date(int(year), int(month), int(day)).toordinal()
+        return day_cache[date]
+
+def merge_intervals(intervals):
+    """ Union of [start, end) intervals, as a sorted list of disjoint intervals """
+
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+def most_common(counts, ignore=()):
+    """ Most frequent item of a dict of counts, as primary_dhb and primary_ethnicity """
+
+    item = None
+    count = 0
+    for key in counts:
+        if key not in ignore and counts[key] > count:
+            count = counts[key]
+            item = key
+    return item
+
+
+class CoverageIndex:
+    """ Merged intervals of medication coverage for everyone in the dispensings file """
+
+    def __init__(self, fname='output/included_records_pd_protection.csv',
+                 persons='output/persons.csv'):
+
+        nhis = OrderedDict()
+        sex = []
+        birth = []
+        ethnicity = []
+        dhb = []
+        intervals = []
+
+        with open(fname) as f:
+            for row in csv.DictReader(f):
+                try:
+                    person = nhis[row['nhi']]
+                except KeyError:
+                    person = nhis[row['nhi']] = len(nhis)
+                    sex.append(row['sex'])
+                    try:
+                        birth.append(parse_day(row['birthdate']))
+                    except ValueError:
+                        birth.append(numpy.nan)
+                    ethnicity.append(defaultdict(int))
+                    dhb.append(defaultdict(int))
+                    intervals.append(defaultdict(list))
+
+                ethnicity[person][row['ethnicity']] += 1
+                dhb[person][row['dhb']] += 1
+
+                if row['days_supply'] == 'NA':
+                    continue
+                start = parse_day(row['date'])
+                intervals[person][row['drug_group']].append((start, start + int(row['days_supply'])))
+
+        self.nhis = nhis.keys()
+        self.birth = numpy.array(birth, dtype=float)
+
+        # Optionally the classification of each person from process.py
+        classification = dict()
+        if persons is not None:
+            try:
+                with open(persons) as f:
+                    for row in csv.DictReader(f):
+                        classification[row['nhi']] = row['classification']
+            except IOError:
+                print "Unable to open {}, classification will be NA".format(persons)
+
+        self.fields = dict()
+        for name, values in (('sex', sex),
+                             ('ethnicity', [most_common(c, ('Unknown',)) or 'Unknown' for c in ethnicity]),
+                             ('dhb', [most_common(c) for c in dhb]),
+                             ('classification', [classification.get(nhi, 'NA') for nhi in self.nhis])):
+            labels, codes = numpy.unique(values, return_inverse=True)
+            self.fields[name] = (labels.tolist(), codes)
+
+        # Merge each person's intervals per drug group, and over all groups
+        self.groups = sorted(set(group for person in intervals for group in person)) + [ANY]
+        group_index = dict((group, i) for i, group in enumerate(self.groups))
+
+        start = []
+        end = []
+        person_of = []
+        group_of = []
+        for person, by_group in enumerate(intervals):
+            by_group[ANY] = [interval for group in by_group for interval in by_group[group]]
+            for group in by_group:
+                for interval in merge_intervals(by_group[group]):
+                    start.append(interval[0])
+                    end.append(interval[1])
+                    person_of.append(person)
+                    group_of.append(group_index[group])
+
+        # Sorted by start so intervals starting after a date are a slice
+        order = numpy.argsort(start, kind='mergesort')
+        self.start = numpy.array(start, dtype=int)[order]
+        self.end = numpy.array(end, dtype=int)[order]
+        self.person = numpy.array(person_of, dtype=int)[order]
+        self.group = numpy.array(group_of, dtype=int)[order]
+
+        # Longest interval bounds how far back a covering interval can start
+        self.longest = int((self.end - self.start).max()) if len(self.start) else 0
+
+    def covering(self, day):
+        """ Indices of the intervals that cover a day number """
+
+        first = numpy.searchsorted(self.start, day - self.longest, side='left')
+        last = numpy.searchsorted(self.start, day, side='right')
+        return first + numpy.flatnonzero(self.end[first:last] > day)
+
+    def labelled(self, by, person, group, day=None, age_scheme='agecut5_85'):
+        """ Labels and codes of each dimension in by, for intervals of person and group """
+
+        labels = []
+        codes = []
+        for name in by:
+            if name == 'group':
+                labels.append(self.groups)
+                codes.append(group)
+            elif name == 'age':
+                ages = (day - self.birth[person])/365.0
+                bands = [counts.age_band(age, *counts.AGE_SCHEMES[age_scheme])
+                         if age == age else 'NA' for age in ages.tolist()]
+                band_labels, band_codes = numpy.unique(bands, return_inverse=True)
+                labels.append(band_labels.tolist())
+                codes.append(band_codes)
+            else:
+                field_labels, field_codes = self.fields[name]
+                labels.append(field_labels)
+                codes.append(field_codes[person])
+        return labels, codes
+
+    def point_counts(self, date, by=('group',), age_scheme='agecut5_85'):
+        """ Number of people covered on a date, as an OrderedDict by the labels of by """
+
+        day = date.toordinal()
+        covering = self.covering(day)
+
+        # Each person is only counted once over all groups if not split by group
+        if 'group' not in by:
+            covering = covering[self.group[covering] == self.groups.index(ANY)]
+        if not len(covering):
+            return OrderedDict()
+
+        labels, codes = self.labelled(by, self.person[covering], self.group[covering],
+                                      day, age_scheme)
+        shape = [len(l) for l in labels]
+        cell = numpy.ravel_multi_index(codes, shape)
+        number = numpy.bincount(cell, minlength=int(numpy.prod(shape))).reshape(shape)
+
+        result = OrderedDict()
+        for index in zip(*numpy.nonzero(number)):
+            result[tuple(labels[i][j] for i, j in enumerate(index))] = int(number[index])
+        return result
+
+    def daily_counts(self, first, last, by=('group',)):
+        """ Number of people covered on every day from first to last
+
+        Returns the labels of each dimension in by, the dates and an array of
+        counts with a dimension for each of by and then the days. Age is not
+        allowed as it changes within an interval.
+        """
+
+        if 'age' in by:
+            raise ValueError("Daily counts can't be split by age")
+
+        first_day = first.toordinal()
+        ndays = last.toordinal() - first_day + 1
+
+        # Each person is only counted once over all groups if not split by group
+        if 'group' in by:
+            selected = numpy.arange(len(self.start))
+        else:
+            selected = numpy.flatnonzero(self.group == self.groups.index(ANY))
+
+        labels, codes = self.labelled(by, self.person[selected], self.group[selected])
+        shape = [len(l) for l in labels]
+        ncells = int(numpy.prod(shape)) if shape else 1
+        cell = numpy.ravel_multi_index(codes, shape) if shape else numpy.zeros(len(selected), dtype=int)
+
+        # +1 on the first day covered and -1 the day after the last, then a running total
+        start = numpy.clip(self.start[selected] - first_day, 0, ndays)
+        end = numpy.clip(self.end[selected] - first_day, 0, ndays)
+        change = numpy.zeros((ncells, ndays + 1), dtype=int)
+        numpy.add.at(change, (cell, start), 1)
+        numpy.add.at(change, (cell, end), -1)
+        number = numpy.cumsum(change, axis=1)[:, :ndays]
+
+        dates = [datetime.date.fromordinal(first_day + i) for i in xrange(ndays)]
+        return labels, dates, number.reshape(shape + [ndays])
+
+
+def write_point_counts(fname, date, by, result):
+
+    with open(fname, "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(['date'] + list(by) + ['n'])
+        for key in result:
+            writer.writerow([date.isoformat()] + list(key) + [result[key]])
+
+def write_daily_counts(fname, by, labels, dates, number):
+
+    with open(fname, "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(['date'] + list(by) + ['n'])
+        for index in numpy.ndindex(*number.shape[:-1]):
+            key = [labels[i][j] for i, j in enumerate(index)]
+            for i, date in enumerate(dates):
+                writer.writerow([date.isoformat()] + key + [number[index][i]])
+
+
+if __name__ == '__main__':
+
+    def iso_date(text):
+        return datetime.datetime.strptime(text, '%Y-%m-%d').date()
+
+    parser = argparse.ArgumentParser(description='Number of people covered by medication')
+    parser.add_argument('date', nargs='?', type=iso_date, help='Date for point counts (YYYY-MM-DD)')
+    parser.add_argument('--series', nargs=2, type=iso_date, metavar=('FIRST','LAST'),
+                        help='Daily counts from FIRST to LAST instead')
+    parser.add_argument('--by', nargs='*', default=['group'],
+                        choices=('group','age') + PERSON_FIELDS)
+    parser.add_argument('--age-scheme', default='agecut5_85', choices=counts.AGE_SCHEMES.keys())
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    index = CoverageIndex()
+
+    if args.series:
+        labels, dates, number = index.daily_counts(args.series[0], args.series[1], args.by)
+        write_daily_counts(args.output or 'output/coverage_daily.csv', args.by, labels, dates, number)
+    elif args.date:
+        result = index.point_counts(args.date, args.by, args.age_scheme)
+        write_point_counts(args.output or 'output/coverage_{}.csv'.format(args.date.isoformat()),
+                           args.date, args.by, result)
+    else:
+        parser.error('Either a date or --series is needed')
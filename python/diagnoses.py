@@ -2,6 +2,17 @@ import sys,traceback
 import csv
 from collections import defaultdict
 
+import sample
+
+# Local diagnoses, in the order they are applied:
+# (name, filename, nhi field, diagnosis field, diagnosis detail field)
+SOURCES = [('Research database', 'input/diagnoses_alice_2016.csv', 'NHI', 'DiseaseGroup', ''),
+           ('Tim PP', 'input/diagnoses_tim_pp_2015.csv', 'nhi', 'Tim_diag2', ''),
+           ('MSPD Society', 'input/diagnoses_mspd_2015.csv', 'nhi', 'mspd_diag2', ''),
+           ('Clinics', 'input/diagnoses_clinic_2015.csv', 'nhi', 'diag2', ''),
+           ('CDHB', 'input/diagnoses_cdhb_2014.csv', 'nhi', 'dhb_diag', ''),
+           ('Neurology database', 'input/diagnoses_neurology_2015.csv', 'nhi', 'diag1', 'diag2')]
+
 class Diagnoses:
     def __init__(self, 
                  local_diagnoses_filename = "input/diagnoses_all_sources.csv", 
@@ -28,6 +39,8 @@ class Diagnoses:
             return
             
         for row in reader:
+            if not sample.keep(row['nhi']):
+                continue
             self.moh_diagnoses[row['nhi']]=row['diagnosis']
             self.all_diagnoses[row['nhi']].append(row['diagnosis'])
         
@@ -44,6 +57,8 @@ class Diagnoses:
             for row in csv.DictReader(open(filename)):
                 
                 nhi = row[nhi_field_name].replace(" ","")
+                if not sample.keep(nhi):
+                    continue
                 diag = row[diagnosis_field_name].replace(" ","")
                 
                 diags[nhi]=diag
@@ -82,36 +97,14 @@ class Diagnoses:
             
             return diags
 
-        rd_diags = process_diagnosis_file(name="Research database",
-                               filename='input/diagnoses_alice_2016.csv',
-                               nhi_field_name='NHI',
-                               diagnosis_field_name = 'DiseaseGroup')     
-
-        process_diagnosis_file(name="Tim PP",
-                               filename='input/diagnoses_tim_pp_2015.csv',
-                               nhi_field_name='nhi',
-                               diagnosis_field_name = 'Tim_diag2')   
-
-        process_diagnosis_file(name="MSPD Society",
-                               filename='input/diagnoses_mspd_2015.csv',
-                               nhi_field_name='nhi',
-                               diagnosis_field_name = 'mspd_diag2')      
-        
-        process_diagnosis_file(name="Clinics",
-                               filename='input/diagnoses_clinic_2015.csv',
-                               nhi_field_name='nhi',
-                               diagnosis_field_name = 'diag2')                
-
-        process_diagnosis_file(name="CDHB",
-                               filename='input/diagnoses_cdhb_2014.csv',
-                               nhi_field_name='nhi',
-                               diagnosis_field_name = 'dhb_diag')   
-
-        process_diagnosis_file(name="Neurology database",
-                               filename='input/diagnoses_neurology_2015.csv',
-                               nhi_field_name='nhi',
-                               diagnosis_field_name = 'diag1',
-                               diagnosis_detail = 'diag2')          
+        for name, filename, nhi_field_name, diagnosis_field_name, diagnosis_detail in SOURCES:
+            diags = process_diagnosis_file(name=name,
+                                           filename=filename,
+                                           nhi_field_name=nhi_field_name,
+                                           diagnosis_field_name=diagnosis_field_name,
+                                           diagnosis_detail=diagnosis_detail)
+            if name == 'Research database':
+                rd_diags = diags
         
 
         try:
@@ -207,5 +200,11 @@ class Diagnoses:
             return moh_diagnosis
         
 if __name__ == '__main__':
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Read the local and MOH diagnoses')
+    sample.add_argument(parser)
+    sample.from_arguments(parser.parse_args())
+    
     diagnoses = Diagnoses()
             
\ No newline at end of file
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+""" Check a candidate classification engine gives the same answers as process.py
+
+The reference (process.classify_person) and a candidate function with the
+same arguments are run on each person, from the exported dispensings or
+from synthetic people. Each person's rows of every output (continuity
+blocks, classification by year, persons, person-years, providers,
+incidence and prescribers not in the register) are compared by digest, the first people who differ are shown
+field by field, and both engines are timed.
+
+    python equivalence.py --candidate fastprocess:classify_person
+    python equivalence.py --synthetic 5000 --seed 1 --candidate fastprocess:classify_person
+    python equivalence.py --synthetic 500 --candidate fastprocess:classify_person --report output/equivalence.json  # in CI
+
+Exits with status 1 if any person differs.
+"""
+from collections import OrderedDict
+import argparse
+import csv
+import datetime
+import hashlib
+import importlib
+import itertools
+import json
+import operator
+import os
+import random
+import sys
+import timeit
+
+import process
+import sample
+
+OUTPUTS = ('continuity','classification','persons','person_years','provider','incidence',
+           'unknown_providers')
+
+# Drugs (and their groups) of synthetic people
+DRUGS = (('Sinemet','L-dopa'), ('Madopar','L-dopa'), ('Kinson','L-dopa'),
+         ('Entacapone','COMT'), ('Tolcapone','COMT'),
+         ('Lisuride','DA agonist'), ('Pergolide','DA agonist'), ('Ropinirole','DA agonist'),
+         ('Bromocriptine','DA agonist'), ('Apomorphine','DA agonist'), ('Pramipexole','DA agonist'),
+         ('Orphenadrine','Anticholinergic'), ('Benztropine','Anticholinergic'),
+         ('Procyclidine','Anticholinergic'), ('Biperiden','Anticholinergic'),
+         ('Selegiline','MAOI'), ('Amantadine','Amantadine'))
+
+DOSES = ('0.125','0.25','0.50','1.00','25.00','100.00','250.00','NA')
+
+DAYS_SUPPLY = ('30','60','90','NA')
+
+ETHNICITIES = ('European','Maori','Pacific','Asian','Other','Unknown')
+
+DHBS = ('Auckland','Waitemata','Counties Manukau','Waikato','Capital and Coast',
+        'Canterbury','Southern')
+
+DIAGNOSES = ('Empty','PD','Other')
+
+
+def load_engine(name):
+    """ Function from 'module:function' """
+
+    module, function = name.split(':')
+    return getattr(importlib.import_module(module), function)
+
+def format_date(date):
+    return date.strftime('%d/%m/%Y')
+
+def synthetic_people(n, seed=0):
+    """ (nhi, records, diagnoses) of n made up people, the same for the same seed """
+
+    generator = random.Random(seed)
+    first_day = datetime.datetime(2006,1,1)
+
+    for i in xrange(n):
+        nhi = 'SYN{:06d}'.format(i)
+        birthdate = datetime.datetime(generator.randint(1920,1990), generator.randint(1,12),
+                                      generator.randint(1,28))
+        if generator.random() < 0.2:
+            date_of_death = format_date(first_day + datetime.timedelta(days=generator.randint(365, 3650)))
+        else:
+            date_of_death = 'NA'
+        person = {'nhi':nhi,
+                  'birthdate':format_date(birthdate),
+                  'date_of_death':date_of_death,
+                  'sex':generator.choice('MF'),
+                  'ethnicity':generator.choice(ETHNICITIES),
+                  'dhb':generator.choice(DHBS)}
+
+        # A run of dispensings of each drug, with breaks that split them into blocks
+        records = []
+        for drug, drug_group in generator.sample(DRUGS, generator.randint(1,3)):
+            date = first_day + datetime.timedelta(days=generator.randint(0, 3000))
+            for j in xrange(generator.randint(1,20)):
+                records.append(dict(person,
+                                    age='{:0.1f}'.format((date - birthdate).days/365.0),
+                                    date=format_date(date),
+                                    drug=drug,
+                                    drug_group=drug_group,
+                                    dose_mg=generator.choice(DOSES),
+                                    days_supply=generator.choice(DAYS_SUPPLY),
+                                    provider_id='SYN{:03d}'.format(generator.randint(1, 50))))
+                date += datetime.timedelta(days=generator.choice((30, 60, 90, 200)))
+
+        records.sort(key=lambda record: datetime.datetime.strptime(record['date'], '%d/%m/%Y'))
+        yield nhi, records, tuple(generator.choice(DIAGNOSES) for k in xrange(3))
+
+def file_people(fname, all_diagnoses=None):
+    """ (nhi, records, diagnoses) of each person in a dispensings file """
+
+    with open(fname) as f:
+        records = csv.DictReader(f)
+        for nhi, person_records in itertools.groupby((record for record in records
+                                                      if sample.keep(record['nhi'])),
+                                                     operator.itemgetter('nhi')):
+            if all_diagnoses is None:
+                person_diagnoses = ('Empty','Empty','Empty')
+            else:
+                person_diagnoses = (all_diagnoses.getDiagnosis(nhi),
+                                    all_diagnoses.getLocalDiagnosis(nhi),
+                                    all_diagnoses.getMohDiagnosis(nhi))
+            yield nhi, list(person_records), person_diagnoses
+
+
+def rows_of(results, output):
+    """ Rows of an output as a list of dicts
+
+    Provider and incidence are a single row, and unknown providers a list of
+    provider IDs.
+    """
+
+    rows = results[output]
+    if isinstance(rows, dict):
+        return [rows]
+    return [row if isinstance(row, dict) else {'provider_id':row} for row in rows]
+
+def digest(results):
+    """ Digest of each output of a person """
+
+    digests = dict()
+    for output in OUTPUTS:
+        sha = hashlib.sha1()
+        for row in rows_of(results, output):
+            sha.update(repr(sorted(row.items())) + '\n')
+        digests[output] = sha.hexdigest()
+    return digests
+
+def differences(reference, candidate):
+    """ Field level differences between two people's results, as a list of strings """
+
+    found = []
+    for output in OUTPUTS:
+        reference_rows = rows_of(reference, output)
+        candidate_rows = rows_of(candidate, output)
+
+        for i in xrange(max(len(reference_rows), len(candidate_rows))):
+            if i >= len(candidate_rows):
+                found.append('{} row {}: missing from candidate'.format(output, i))
+            elif i >= len(reference_rows):
+                found.append('{} row {}: extra in candidate'.format(output, i))
+            else:
+                for field in sorted(set(reference_rows[i]) | set(candidate_rows[i])):
+                    expected = reference_rows[i].get(field, 'missing')
+                    actual = candidate_rows[i].get(field, 'missing')
+                    if expected != actual:
+                        found.append('{} row {} {}: {!r} != {!r}'.format(output, i, field,
+                                                                          expected, actual))
+    return found
+
+
+class Comparison:
+    """ Running totals of a comparison of two engines, person by person """
+
+    def __init__(self, reference, candidate, providers, max_shown=10):
+        self.reference = reference
+        self.candidate = candidate
+        self.providers = providers
+        self.max_shown = max_shown
+        self.people = 0
+        self.differing = 0
+        self.differing_outputs = OrderedDict((output, 0) for output in OUTPUTS)
+        self.shown = OrderedDict()
+        self.times = {'reference':0.0, 'candidate':0.0}
+
+    def run(self, engine, nhi, records, person_diagnoses):
+        """ Results and time taken of an engine, without its progress messages """
+
+        stdout = sys.stdout
+        with open(os.devnull, "w") as devnull:
+            sys.stdout = devnull
+            try:
+                start = timeit.default_timer()
+                results = engine(nhi, records, person_diagnoses, self.providers)
+                return results, timeit.default_timer() - start
+            finally:
+                sys.stdout = stdout
+
+    def add(self, nhi, records, person_diagnoses):
+
+        self.people += 1
+
+        expected, elapsed = self.run(self.reference, nhi, records, person_diagnoses)
+        self.times['reference'] += elapsed
+        actual, elapsed = self.run(self.candidate, nhi, records, person_diagnoses)
+        self.times['candidate'] += elapsed
+
+        expected_digests = digest(expected)
+        actual_digests = digest(actual)
+        if expected_digests == actual_digests:
+            return
+
+        self.differing += 1
+        for output in OUTPUTS:
+            if expected_digests[output] != actual_digests[output]:
+                self.differing_outputs[output] += 1
+        if len(self.shown) < self.max_shown:
+            self.shown[nhi] = differences(expected, actual)
+
+    def speedup(self):
+        if self.times['candidate'] == 0:
+            return None
+        return self.times['reference']/self.times['candidate']
+
+    def report(self):
+
+        print "{} people compared, {} differ".format(self.people, self.differing)
+        for output in OUTPUTS:
+            if self.differing_outputs[output]:
+                print "  {}: {} people".format(output, self.differing_outputs[output])
+
+        for nhi in self.shown:
+            print "{}:".format(nhi)
+            for difference in self.shown[nhi]:
+                print "  {}".format(difference)
+
+        speedup = self.speedup()
+        print "Reference {:.2f}s, candidate {:.2f}s, speedup {}".format(
+            self.times['reference'], self.times['candidate'],
+            'NA' if speedup is None else '{:.2f}x'.format(speedup))
+
+    def write(self, fname):
+        """ Summary as JSON, e.g. to keep from a CI run """
+
+        with open(fname, "w") as f:
+            json.dump(OrderedDict([('people', self.people),
+                                   ('differing', self.differing),
+                                   ('differing_outputs', self.differing_outputs),
+                                   ('first_differences', self.shown),
+                                   ('seconds', self.times),
+                                   ('speedup', self.speedup())]), f, indent=1)
+
+
+def compare(people, candidate, reference=process.classify_person, providers=None, max_shown=10):
+    """ Compare the engines on each (nhi, records, diagnoses) of people """
+
+    if providers is None:
+        providers = process.Providers()
+
+    comparison = Comparison(reference, candidate, providers, max_shown)
+    for nhi, records, person_diagnoses in people:
+        comparison.add(nhi, records, person_diagnoses)
+    return comparison
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compare a classification engine against process.py')
+    parser.add_argument('--candidate', required=True, metavar='MODULE:FUNCTION',
+                        help='Function taking (nhi, records, diagnoses, providers) like process.classify_person')
+    parser.add_argument('--reference', default='process:classify_person', metavar='MODULE:FUNCTION')
+    parser.add_argument('--input', default='output/included_records_pd_protection.csv',
+                        help='Dispensings exported by pharmacdata.py')
+    parser.add_argument('--diagnoses', nargs=2, metavar=('LOCAL','MOH'),
+                        help='Diagnoses files, otherwise everyone has empty diagnoses')
+    parser.add_argument('--medical-council', default=process.MEDICAL_COUNCIL,
+                        help='Register of prescribers, for the provider summary')
+    parser.add_argument('--synthetic', type=int, metavar='N',
+                        help='Compare on N synthetic people instead of the input')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic people')
+    parser.add_argument('--show', type=int, default=10, help='Number of differing people shown')
+    parser.add_argument('--report', help='Also write the results to this JSON file')
+    sample.add_argument(parser)
+    args = parser.parse_args()
+    sample.from_arguments(args)
+
+    if args.synthetic is not None:
+        people = synthetic_people(args.synthetic, args.seed)
+    else:
+        all_diagnoses = None
+        if args.diagnoses:
+            import diagnoses
+            all_diagnoses = diagnoses.Diagnoses(*args.diagnoses)
+        people = file_people(args.input, all_diagnoses)
+
+    comparison = compare(people, load_engine(args.candidate), load_engine(args.reference),
+                         process.Providers(args.medical_council), args.show)
+    comparison.report()
+    if args.report:
+        comparison.write(args.report)
+
+    sys.exit(1 if comparison.differing else 0)
@@ -0,0 +1,142 @@
+""" External merge sort of records too many to sort in memory
+
+Records (tuples of numbers, strings and None) are collected in memory up
+to a budget, then sorted and written to disk as a run of marshalled
+records. Reading back merges the runs (and whatever is still in memory)
+into one stream in sorted order. Records are compared as tuples, so the
+fields to sort by go first.
+
+Several sorted streams can then be joined on their first field, keeping
+only one key's records from each in memory at a time.
+
+    sorter = ExternalSort('output/staging', memory=256*2**20)
+    for record in records:
+        sorter.add((record['nhi'], record['date'], ...))
+    for record in sorter.sorted():
+        ...
+"""
+import heapq
+import itertools
+import marshal
+import operator
+import os
+import sys
+
+# Records measured to estimate the memory used by each
+MEASURED = 1000
+
+def record_size(record):
+    """ Approximate memory used by a record, with its fields """
+    return sys.getsizeof(record) + sum(sys.getsizeof(field) for field in record)
+
+def read_run(fname):
+    """ Records of a run, in order """
+
+    with open(fname, "rb") as f:
+        while True:
+            try:
+                yield marshal.load(f)
+            except EOFError:
+                return
+
+class ExternalSort:
+    """ Sorted runs on disk and a buffer of records in memory
+
+    runs is the list of run files already written (from a checkpoint of an
+    earlier run), any other runs in the directory are removed.
+    """
+
+    def __init__(self, directory, memory=256*2**20, runs=None, fan_in=64):
+        self.directory = directory
+        self.memory = memory
+        self.fan_in = fan_in
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.runs = list(runs or [])
+        for fname in os.listdir(directory):
+            if os.path.join(directory, fname) not in self.runs:
+                os.remove(os.path.join(directory, fname))
+
+        self.buffer = []
+        self.capacity = None
+        self.measured = 0
+
+    def next_fname(self):
+        n = len(self.runs)
+        while os.path.exists(os.path.join(self.directory, 'run_{}.bin'.format(n))):
+            n += 1
+        return os.path.join(self.directory, 'run_{}.bin'.format(n))
+
+    def add(self, record):
+
+        self.buffer.append(record)
+
+        # Number of records in the budget, from the size of the first ones
+        if self.capacity is None:
+            self.measured += record_size(record)
+            if len(self.buffer) == MEASURED:
+                self.capacity = max(MEASURED, self.memory*MEASURED//self.measured)
+
+        if self.capacity is not None and len(self.buffer) >= self.capacity:
+            self.spill()
+
+    def write_run(self, records):
+
+        fname = self.next_fname()
+        with open(fname, "wb") as f:
+            for record in records:
+                marshal.dump(record, f)
+        return fname
+
+    def spill(self):
+        """ Write the records in memory to disk as a sorted run """
+
+        if not self.buffer:
+            return
+
+        self.buffer.sort()
+        self.runs.append(self.write_run(self.buffer))
+        self.buffer = []
+
+    def sorted(self):
+        """ All the records added, in order """
+
+        # Merge runs a fan_in at a time until few enough to have open at once
+        while len(self.runs) > self.fan_in:
+            merging = self.runs[:self.fan_in]
+            fname = self.write_run(heapq.merge(*[read_run(run) for run in merging]))
+            self.runs = self.runs[self.fan_in:] + [fname]
+            for run in merging:
+                os.remove(run)
+
+        self.buffer.sort()
+        return heapq.merge(self.buffer, *[read_run(run) for run in self.runs])
+
+    def clear(self):
+        """ Remove the runs from disk """
+
+        for run in self.runs:
+            os.remove(run)
+        self.runs = []
+        self.buffer = []
+
+
+def tagged(i, stream):
+    """ Records of a stream with their key and the index of the stream """
+    for record in stream:
+        yield record[0], i, record
+
+def join(*streams):
+    """ Merge streams of records, each sorted by their first field, on that field
+
+    Yields each key with a list for each stream of its records with that key.
+    """
+
+    merged = heapq.merge(*[tagged(i, stream) for i, stream in enumerate(streams)])
+    for key, group in itertools.groupby(merged, operator.itemgetter(0)):
+        records = [[] for stream in streams]
+        for key, i, record in group:
+            records[i].append(record)
+        yield key, records
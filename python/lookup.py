@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+""" Look up everything known about a person
+
+The dispensings in output/pharmac.db (from each of its partitions) and the
+pipeline outputs are copied into one SQLite store (output/lookup.db), with
+every table indexed by NHI, so one person's dispensings, continuity blocks,
+classification by year, diagnoses from each source and MOH deaths and
+admissions are a handful of indexed queries.
+
+    python lookup.py build                  # (Re)build the store
+    python lookup.py show ABC1234 ABC5678   # Print people as JSON
+    python lookup.py show --file nhis.txt   # One NHI per line, a JSON line per person
+    python lookup.py serve --port 8000      # http://localhost:8000/person/ABC1234
+"""
+from collections import OrderedDict
+import argparse
+import BaseHTTPServer
+import csv
+import json
+import os
+import sqlite3
+import urlparse
+
+import diagnoses
+import pharmacdata
+
+STORE = 'output/lookup.db'
+
+PHARMAC_DB = pharmacdata.PHARMAC_DB
+
+# Pipeline outputs with one or more rows per person
+TABLES = OrderedDict([
+        ('continuity', 'output/continuity.csv'),
+        ('classification', 'output/classification.csv'),
+        ('moh_events', 'output/moh_events.csv'),
+        ('moh_conditions', 'output/moh_conditions.csv'),
+    ])
+
+def day_key(date):
+    """ Sort key of a dd/mm/yyyy date """
+    try:
+        day, month, year = date.split('/')
+        return (int(year), int(month), int(day))
+    except ValueError:
+        return (0, 0, 0)
+
+def load_csv(db, table, fname):
+    """ Copy a csv file into a table of the store, indexed by nhi """
+
+    with open(fname) as f:
+        reader = csv.reader(f)
+        header = reader.next()
+        db.execute('CREATE TABLE {} ({})'.format(table, ', '.join('{} text'.format(field)
+                                                                 for field in header)))
+        db.executemany('INSERT INTO {} VALUES ({})'.format(table, ','.join('?'*len(header))),
+                       reader)
+    db.execute('CREATE INDEX {0}_nhi ON {0}(nhi)'.format(table))
+
+
+def build(fname=STORE, pharmac_db=PHARMAC_DB, tables=TABLES):
+    """ Build the store from the dispensings database and pipeline outputs """
+
+    if os.path.exists(fname+'.tmp'):
+        os.remove(fname+'.tmp')
+
+    conn = sqlite3.connect(fname+'.tmp')
+    db = conn.cursor()
+
+    # Dispensings from each partition, in NHI order so each person's rows are together on disk.
+    # Dates are day numbers and drug, ethnicity, DHB and provider codes of the main database's lookup tables
+    if os.path.exists(pharmac_db):
+        conn.create_function('format_day', 1,
+                             lambda day: pharmacdata.format_day(day) if day is not None else None)
+        db.execute('ATTACH DATABASE ? AS pharmac', (pharmac_db,))
+        db.execute('''CREATE TABLE dispensings (nhi text, birthdate text, date_of_death text, age real,
+                      sex text, ethnicity text, dhb text, date text, drug text, drug_group text,
+                      dose_mg real, days_supply integer, provider_id text)''')
+        for part_fname in pharmacdata.partition_files(pharmac_db):
+            db.execute('ATTACH DATABASE ? AS part', (part_fname,))
+            db.execute('''INSERT INTO dispensings
+                          SELECT d.nhi, format_day(d.birthdate), format_day(d.date_of_death),
+                                 round((d.date - d.birthdate)/365.0, 1), d.sex, e.ethnicity, h.dhb,
+                                 format_day(d.date), g.drug, g.drug_group, d.dose_mg, d.days_supply,
+                                 p.provider
+                          FROM part.dispensings d
+                          JOIN pharmac.drugs g ON g.code = d.drug
+                          JOIN pharmac.ethnicities e ON e.code = d.ethnicity
+                          JOIN pharmac.dhbs h ON h.code = d.dhb
+                          JOIN pharmac.providers p ON p.code = d.provider
+                          ORDER BY d.nhi, d.date''')
+            conn.commit()
+            db.execute('DETACH DATABASE part')
+        db.execute('DETACH DATABASE pharmac')
+        db.execute('CREATE INDEX dispensings_nhi ON dispensings(nhi)')
+    else:
+        print "Unable to open {}, there will be no dispensings".format(pharmac_db)
+    
+    for table in tables:
+        try:
+            load_csv(db, table, tables[table])
+        except IOError:
+            print "Unable to open {}, there will be no {}".format(tables[table], table)
+
+    # Diagnoses from each local source and MOH, as one table
+    db.execute('CREATE TABLE diagnoses (nhi text, source text, diagnosis text)')
+    for name, filename, nhi_field_name, diagnosis_field_name, diagnosis_detail in diagnoses.SOURCES:
+        try:
+            with open(filename) as f:
+                db.executemany('INSERT INTO diagnoses VALUES (?,?,?)',
+                               ((row[nhi_field_name].replace(" ",""), name,
+                                 row[diagnosis_field_name].replace(" ",""))
+                                for row in csv.DictReader(f)))
+        except IOError:
+            print "Unable to open {}, there will be no {} diagnoses".format(filename, name)
+    try:
+        with open('output/moh_diagnoses.csv') as f:
+            db.executemany('INSERT INTO diagnoses VALUES (?,?,?)',
+                           ((row['nhi'], 'MOH', row['diagnosis']) for row in csv.DictReader(f)))
+    except IOError:
+        print "Unable to open output/moh_diagnoses.csv, there will be no MOH diagnoses"
+    db.execute('CREATE INDEX diagnoses_nhi ON diagnoses(nhi)')
+
+    conn.commit()
+    conn.close()
+    os.rename(fname+'.tmp', fname)
+
+
+class Lookup:
+    """ Queries of the store for one or more people """
+
+    def __init__(self, fname=STORE):
+
+        if not os.path.exists(fname):
+            raise IOError("No store {}, run 'python lookup.py build' first".format(fname))
+
+        self.conn = sqlite3.connect(fname, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.tables = [row[0] for row in self.conn.execute(
+                           "SELECT name FROM sqlite_master WHERE type='table'")]
+
+    def rows(self, table, nhi):
+        return [OrderedDict(zip(row.keys(), row)) for row in
+                self.conn.execute('SELECT * FROM {} WHERE nhi=?'.format(table), (nhi,))]
+
+    def person(self, nhi):
+        """ Everything known about a person, as an OrderedDict of lists of rows """
+
+        person = OrderedDict([('nhi', nhi)])
+        for table in ['dispensings','continuity','classification','diagnoses',
+                      'moh_events','moh_conditions']:
+            if table in self.tables:
+                person[table] = self.rows(table, nhi)
+
+        # Dates are dd/mm/yyyy so order in python
+        if 'dispensings' in person:
+            person['dispensings'].sort(key=lambda row: day_key(row['date']))
+        if 'continuity' in person:
+            person['continuity'].sort(key=lambda row: (row['drug'], int(row['block'])))
+        if 'classification' in person:
+            person['classification'].sort(key=lambda row: row['year'])
+
+        return person
+
+    def people(self, nhis):
+        """ Everything known about each of a list of people """
+        for nhi in nhis:
+            yield self.person(nhi)
+
+
+class LookupHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ GET /person/<nhi> or /people?nhi=<nhi>,<nhi>... returning JSON """
+
+    lookup = None
+
+    def do_GET(self):
+
+        url = urlparse.urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+
+        if len(parts) == 2 and parts[0] == 'person':
+            result = self.lookup.person(parts[1])
+        elif parts == ['people']:
+            nhis = [nhi for value in urlparse.parse_qs(url.query).get('nhi', [])
+                    for nhi in value.split(',') if nhi]
+            result = list(self.lookup.people(nhis))
+        else:
+            self.send_error(404, "Use /person/<nhi> or /people?nhi=<nhi>,<nhi>")
+            return
+
+        body = json.dumps(result)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(port=8000, fname=STORE):
+    """ Serve lookups on localhost only, as the data is identifiable """
+
+    LookupHandler.lookup = Lookup(fname)
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), LookupHandler)
+    print "Serving lookups on http://127.0.0.1:{}/person/<nhi>".format(port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Look up people by NHI')
+    commands = parser.add_subparsers(dest='command')
+
+    commands.add_parser('build', help='Build the store from pharmac.db and the pipeline outputs')
+
+    show = commands.add_parser('show', help='Print people as JSON')
+    show.add_argument('nhis', nargs='*', metavar='NHI')
+    show.add_argument('--file', help='File of NHIs, one per line')
+
+    server = commands.add_parser('serve', help='Serve lookups over HTTP on localhost')
+    server.add_argument('--port', type=int, default=8000)
+
+    parser.add_argument('--store', default=STORE)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build(args.store)
+    elif args.command == 'serve':
+        serve(args.port, args.store)
+    else:
+        nhis = list(args.nhis)
+        if args.file:
+            with open(args.file) as f:
+                nhis.extend(line.strip() for line in f if line.strip())
+
+        lookup = Lookup(args.store)
+        if args.file:
+            for person in lookup.people(nhis):
+                print json.dumps(person)
+        else:
+            print json.dumps(list(lookup.people(nhis)), indent=1)
@@ -1,25 +1,512 @@
 from collections import defaultdict, OrderedDict
 import dateutil.parser
 import datetime
+import hashlib
+import math
 import operator
 import sys,traceback
+import itertools
 import csv
+import multiprocessing
+import os
+import numpy
 
+import extsort
 import pharmacdata
+import sample
+from conditions import CONDITIONS, ConditionMatcher
 
-class MOHData:
-    """ Process the raw MOH data and output into a csv file useful for diagnoses """
+
+year_cache = dict()
+
+def parse_year(date):
+    """ Year of a date string, parsing each distinct string only once """
+    try:
+        return year_cache[date]
+    except KeyError:
+        year = dateutil.parser.parse(date,dayfirst=True).year
+        year_cache[date] = year
+        return year
+
+def read_chunks(f, columns, chunk_size=100000):
+    """ Read a csv file in chunks of rows, yielding a 2D array of the requested columns """
+    
+    reader = csv.reader(f)
+    header = reader.next()
+    index = [header.index(column) for column in columns]
+    
+    while True:
+        rows = list(itertools.islice(reader, chunk_size))
+        if not rows:
+            break
+        yield numpy.array([[row[i] for i in index] for row in rows])
+
+
+class DiagnosisCounts:
+    """ Admission and distinct person counts per ICD code
+    
+    NHIs and codes are mapped to integer ids, and each (code, person) pair is kept
+    once as a single int64, so memory grows with distinct pairs rather than with
+    the total number of diagnoses.
+    """
     
     def __init__(self):
+        self.nhi_ids = dict()
+        self.code_ids = dict()
+        self.admissions = numpy.zeros(0, dtype=numpy.int64)
+        self.pairs = numpy.zeros(0, dtype=numpy.int64)
+        self.pending = []
+        self.npending = 0
+    
+    def to_ids(self, values, mapping):
+        uniq, inverse = numpy.unique(values, return_inverse=True)
+        ids = numpy.array([mapping.setdefault(value, len(mapping)) for value in uniq.tolist()],
+                          dtype=numpy.int64)
+        return ids[inverse]
+    
+    def add(self, nhis, codes):
+        """ Add a chunk: nhis has shape (n,), codes has shape (n, ncolumns) with '' when empty """
+        
+        rows, columns = numpy.nonzero(codes != '')
+        if len(rows) == 0:
+            return
+        
+        code_ids = self.to_ids(codes[rows, columns], self.code_ids)
+        nhi_ids = self.to_ids(nhis, self.nhi_ids)[rows]
+        
+        counts = numpy.bincount(code_ids, minlength=len(self.code_ids))
+        counts[:len(self.admissions)] += self.admissions
+        self.admissions = counts
+        
+        pairs = numpy.unique((code_ids << 32) | nhi_ids)
+        self.pending.append(pairs)
+        self.npending += len(pairs)
+        
+        # Merge pending pairs once they outgrow the merged set (amortised linear)
+        if self.npending > len(self.pairs):
+            self.compact()
+    
+    def compact(self):
+        if self.pending:
+            self.pairs = numpy.unique(numpy.concatenate([self.pairs] + self.pending))
+            self.pending = []
+            self.npending = 0
+    
+    def codes(self):
+        return sorted(self.code_ids.keys())
+    
+    def admission_count(self, code):
+        try:
+            return int(self.admissions[self.code_ids[code]])
+        except KeyError:
+            return 0
+    
+    def distinct_counts(self):
+        """ Dictionary of ICD code to number of distinct people """
+        
+        self.compact()
+        counts = numpy.bincount(self.pairs >> 32, minlength=len(self.code_ids))
+        return dict((code, int(counts[i])) for code, i in self.code_ids.iteritems())
+
+class ApproximateDiagnosisCounts(DiagnosisCounts):
+    """ Exact admission counts, with the distinct people per ICD code estimated
+    
+    Each code has a HyperLogLog sketch of the NHIs seen with it, instead of
+    every (code, person) pair. The standard error of the estimates is about
+    error (1.04/sqrt(m) for m registers per code), and memory is m bytes per
+    code whatever the number of people.
+    """
+    
+    def __init__(self, error=0.02):
+        DiagnosisCounts.__init__(self)
+        
+        # Number of registers is a power of 2 with the error at most the one asked for
+        self.precision = min(max(int(math.ceil(math.log((1.04/error)**2, 2))), 4), 18)
+        self.m = 1 << self.precision
+        self.error = 1.04/math.sqrt(self.m)
+        self.registers = numpy.zeros((0, self.m), dtype=numpy.uint8)
+    
+    def hashes(self, nhis):
+        """ 64 bit hashes of NHIs, hashing each distinct NHI of a chunk once """
+        
+        uniq, inverse = numpy.unique(nhis, return_inverse=True)
+        hashes = numpy.array([int(hashlib.md5(nhi).hexdigest()[:16], 16) for nhi in uniq.tolist()],
+                             dtype=numpy.uint64)
+        return hashes[inverse]
+    
+    def add(self, nhis, codes):
+        """ Add a chunk: nhis has shape (n,), codes has shape (n, ncolumns) with '' when empty """
+        
+        rows, columns = numpy.nonzero(codes != '')
+        if len(rows) == 0:
+            return
+        
+        code_ids = self.to_ids(codes[rows, columns], self.code_ids)
+        
+        counts = numpy.bincount(code_ids, minlength=len(self.code_ids))
+        counts[:len(self.admissions)] += self.admissions
+        self.admissions = counts
+        
+        if len(self.registers) < len(self.code_ids):
+            registers = numpy.zeros((len(self.code_ids), self.m), dtype=numpy.uint8)
+            registers[:len(self.registers)] = self.registers
+            self.registers = registers
+        
+        # Register from the top bits of the hash, and the position of the first
+        # 1 bit of the low 32 bits as the rank
+        hashes = self.hashes(nhis)[rows]
+        index = (hashes >> numpy.uint64(64 - self.precision)).astype(numpy.int64)
+        low = (hashes & numpy.uint64(0xffffffff)).astype(numpy.float64)
+        rank = numpy.full(len(hashes), 33, dtype=numpy.uint8)
+        nonzero = low > 0
+        rank[nonzero] = 32 - numpy.floor(numpy.log2(low[nonzero])).astype(numpy.uint8)
+        
+        numpy.maximum.at(self.registers, (code_ids, index), rank)
+    
+    def compact(self):
+        pass
+    
+    def distinct_counts(self):
+        """ Dictionary of ICD code to estimated number of distinct people """
+        
+        if self.m == 16:
+            alpha = 0.673
+        elif self.m == 32:
+            alpha = 0.697
+        elif self.m == 64:
+            alpha = 0.709
+        else:
+            alpha = 0.7213/(1 + 1.079/self.m)
         
-        nhi_all =set()
-        nhi_pd = set()
-        nhi_pharmac=set()
+        registers = self.registers.astype(numpy.float64)
+        estimates = alpha*self.m*self.m/numpy.power(2.0, -registers).sum(axis=1)
+        
+        # Small range correction by linear counting
+        zeros = (self.registers == 0).sum(axis=1)
+        small = (estimates <= 2.5*self.m) & (zeros > 0)
+        estimates[small] = self.m*numpy.log(self.m/zeros[small].astype(numpy.float64))
+        
+        return dict((code, int(round(estimates[i]))) for code, i in self.code_ids.iteritems())
+
+MORTALITY_FILES = ('raw/mos3358all/mos3358.csv',
+                   'raw/mos3464/mos3464.csv')
+
+ADMISSIONS_FILE = 'raw/pus9058all/pus9058.csv'
+
+PHARMAC_FILE = 'output/included_records_pd_protection.csv'
+
+MORTALITY_ICD_FIELDS = ('icda', #Underlying cause of death
+                        'icdd', #Underlying cause of death
+                        'icdf1','icdf2','icdf3','icdf4', #Other relevant diseases present
+                        'icdg1','icdg2', #Other contributing causes
+                        'icdc1','icdc2','icdj1','icdj2' #Cancer as non-contributing cause
+                        )
+
+LINKAGE_DIR = 'output/linkage'
+
+def condition_mask(names, conditions):
+    """ Bit mask of which of the conditions are in names """
+    return sum(1 << i for i, name in enumerate(conditions) if name in names)
+
+def scan_mortality(fname, conditions, directory, memory=256*2**20):
+    """ Scan a mortality file, returning partial results to be merged by MOHData
+    
+    The columns (which NHI field, which ICD fields) are resolved once from the
+    header, and each record is then handled once with all its ICD fields.
+    
+    Each record's (nhi, condition mask, no PD) is sorted by NHI into runs in
+    directory, for linking to the other sources.
+    """
+    
+    matcher = ConditionMatcher(conditions)
+    sorter = extsort.ExternalSort(directory, memory)
+    
+    result = {'source':'Mortality',
+              'records':0,
+              'pd_records':0,
+              'hits':[]}
+    
+    with open(fname, "r") as f:
+        reader = csv.reader(f)
+        header = reader.next()
+        
+        if 'MAST_NHI' in header:
+            nhi_index = header.index('MAST_NHI')
+        else:
+            nhi_index = header.index('PRIM_HCU')
+        icd_index = [header.index(field) for field in MORTALITY_ICD_FIELDS if field in header]
+        
+        regyr, dod, age, sex, dhb = [header.index(field) for field in 
+                                     ('REGYR','DOD','AGE_AT_DEATH_YRS','SEX','DHBDOM')]
+        
+        for row in reader:
+            nhi = row[nhi_index]
+            if not sample.keep(nhi):
+                continue
+            
+            result['records'] +=1
+            
+            names = set()
+            for i in icd_index:
+                if row[i]:
+                    names.update(matcher.match(row[i]))
+            
+            if 'PD' in names:
+                result['pd_records']+=1
+            sorter.add((nhi, condition_mask(names, conditions), int('PD' not in names)))
+            
+            for name in conditions:
+                if name in names:
+                    result['hits'].append({'condition':name,
+                                           'nhi':nhi,
+                                           'registration_year':row[regyr],
+                                           'date':row[dod],
+                                           'year':parse_year(row[dod]),
+                                           'age':row[age],
+                                           'sex':row[sex],
+                                           'dhb':row[dhb]})
+    
+    sorter.spill()
+    result['runs'] = sorter.runs
+    return result
+
+def scan_admissions(fname, conditions, directory, chunk_size=100000, memory=256*2**20,
+                    distinct_error=None):
+    """ Scan the admissions file, returning partial results to be merged by MOHData
+    
+    Each person's (nhi, condition mask) in a chunk is sorted by NHI into runs in
+    directory, for linking to the other sources. The distinct people with each
+    ICD code are counted exactly, or estimated to about distinct_error if given.
+    """
+    
+    matcher = ConditionMatcher(conditions)
+    sorter = extsort.ExternalSort(directory, memory)
+    
+    if distinct_error is None:
+        diagnoses = DiagnosisCounts()
+    else:
+        diagnoses = ApproximateDiagnosisCounts(distinct_error)
+    
+    result = {'source':'Admissions',
+              'records':0,
+              'diagnoses':diagnoses,
+              'hits':[]}
+    
+    diagfields = ['diag{:02.0f}'.format(i) for i in xrange(1,31)]
+    columns = ['MAST_NHI','EVSTDATE','AGE_DSCH','GENDER','DHBDOM'] + diagfields
+    
+    with open(fname, "r") as f:
+        for chunk in read_chunks(f, columns, chunk_size):
+            
+            if sample.fraction is not None:
+                chunk = chunk[sample.keep_array(chunk[:,0])]
+            
+            result['records'] += len(chunk)
+            nhis = chunk[:,0]
+            codes = chunk[:,5:]
+            
+            result['diagnoses'].add(nhis, codes)
+            
+            # Only admissions with a condition need to be looked at individually
+            hits = matcher.match_array(codes)
+            masks = numpy.zeros(len(chunk), dtype=numpy.int64)
+            for i, name in enumerate(hits):
+                matched = hits[name].any(axis=1)
+                masks[matched] |= 1 << i
+                for row in chunk[matched].tolist():
+                    result['hits'].append({'condition':name,
+                                           'nhi':row[0],
+                                           'date':row[1],
+                                           'year':parse_year(row[1]),
+                                           'age':row[2],
+                                           'sex':row[3],
+                                           'dhb':row[4]})
+            
+            # One entry for each person in the chunk, with all their conditions
+            order = numpy.argsort(nhis, kind='mergesort')
+            nhis = nhis[order]
+            starts = numpy.flatnonzero(numpy.r_[True, nhis[1:] != nhis[:-1]])
+            for nhi, mask in itertools.izip(nhis[starts].tolist(),
+                                            numpy.bitwise_or.reduceat(masks[order], starts).tolist()):
+                sorter.add((nhi, mask))
+    
+    result['diagnoses'].compact()
+    sorter.spill()
+    result['runs'] = sorter.runs
+    return result
+
+def sort_pharmac_nhis(fname, directory, memory=256*2**20):
+    """ Sort the NHIs of everyone in the pharmac data into runs in directory
+    
+    Read from the exported dispensings (pharmacdata.py) rather than the
+    classification (process.py), as process.py itself uses the MOH diagnoses.
+    """
+    
+    sorter = extsort.ExternalSort(directory, memory)
+    with open(fname, "r") as f:
+        reader = csv.reader(f)
+        nhi_index = reader.next().index('nhi')
+        
+        # Each person's dispensings are together, so mostly only their first is sorted
+        last = None
+        for row in reader:
+            nhi = row[nhi_index]
+            if nhi != last and sample.keep(nhi):
+                sorter.add((nhi,))
+            last = nhi
+    
+    sorter.spill()
+    return sorter.runs
+
+
+class MOHData:
+    """ Process the raw MOH data and output into a csv file useful for diagnoses
+    
+    All conditions in the registry (see conditions.py) are matched in the same
+    pass over the mortality and admission files. PD is the condition used for
+    the MOH diagnoses.
+    
+    Each mortality file and the admissions file is scanned in its own worker
+    process. Each source's NHIs (with the conditions found for them) are
+    sorted on disk, under output/linkage/, and the sources are then linked to
+    each other, and to the pharmac data, with one merge of the sorted NHIs.
+    Only the deaths and admissions with a condition are kept in memory.
+    
+    The distinct people with each ICD code in output/admission_diagnoses.csv
+    are exact, unless distinct_error is given for estimates with about that
+    relative standard error, using much less memory.
+    """
+    
+    def __init__(self, conditions=None, chunk_size=100000, processes=None,
+                 pharmac_filename=PHARMAC_FILE, directory=LINKAGE_DIR, sort_memory=256*2**20,
+                 distinct_error=None):
+        
+        if conditions is None:
+            conditions = CONDITIONS
         
         self.pharms = pharmacdata.PharmacData()
         
-        pharmac_missing_mortality=defaultdict(int)
-        pharmac_missing_admission=defaultdict(int)
+        mortality_dirs = [os.path.join(directory, 'mortality_{}'.format(i))
+                          for i in xrange(len(MORTALITY_FILES))]
+        admissions_dir = os.path.join(directory, 'admissions')
+        pharmac_dir = os.path.join(directory, 'pharmac')
+        
+        ## Scan mortality and admission data
+        
+        if processes == 1:
+            mortality = [scan_mortality(fname, conditions, mortality_dir, sort_memory)
+                         for fname, mortality_dir in zip(MORTALITY_FILES, mortality_dirs)]
+            admissions = scan_admissions(ADMISSIONS_FILE, conditions, admissions_dir,
+                                         chunk_size, sort_memory, distinct_error)
+            pharmac_runs = sort_pharmac_nhis(pharmac_filename, pharmac_dir, sort_memory)
+        else:
+            pool = multiprocessing.Pool(processes, sample.set_fraction, (sample.fraction,))
+            mortality = [pool.apply_async(scan_mortality, (fname, conditions, mortality_dir, sort_memory))
+                         for fname, mortality_dir in zip(MORTALITY_FILES, mortality_dirs)]
+            admissions = pool.apply_async(scan_admissions, (ADMISSIONS_FILE, conditions, admissions_dir,
+                                                            chunk_size, sort_memory, distinct_error))
+            pool.close()
+            
+            # Sort NHIs from pharmac data while the scans run
+            pharmac_runs = sort_pharmac_nhis(pharmac_filename, pharmac_dir, sort_memory)
+            
+            mortality = [result.get() for result in mortality]
+            admissions = admissions.get()
+            pool.join()
+        
+        self.merge(conditions, pharmac_runs, mortality, admissions, directory, sort_memory)
+    
+    def link(self, conditions, pharmac, mortality, admissions, moh_conditions):
+        """ Merge the NHIs sorted from each source, counting the overlaps between them
+        
+        Writes output/moh_diagnoses.csv, and (condition, nhi, in_pharmac) of
+        everyone with a condition to the moh_conditions sorter. Returns the
+        counts and the set of people with a condition who are in pharmac.
+        """
+        
+        counts = {'pharmac':0,
+                  'mortality_pd':0,
+                  'other_in_pharmac':0,
+                  'pd_not_noted_on_death':0,
+                  'conditions':[0]*len(conditions),
+                  'conditions_in_pharmac':[0]*len(conditions)}
+        linked = set()
+        pd = 1 << list(conditions).index('PD')
+        
+        fields =OrderedDict([('nhi',1),
+                             ('diagnosis',2),
+                             ('ethnicity',3),
+                             ])
+        
+        f_out = open('output/moh_diagnoses.csv',"w")
+        dwd = csv.DictWriter(f_out, delimiter=',',restval='NA',fieldnames=fields)
+        dwd.writeheader()
+        
+        streams = [pharmac.sorted(), admissions.sorted()] + [sorter.sorted() for sorter in mortality]
+        for nhi, records in extsort.join(*streams):
+            
+            in_pharmac = len(records[0]) > 0
+            in_admissions = len(records[1]) > 0
+            deaths = [record for source in records[2:] for record in source]
+            
+            death_mask = 0
+            no_pd_mortality = False
+            for record in deaths:
+                death_mask |= record[1]
+                no_pd_mortality = no_pd_mortality or record[2]
+            admission_mask = 0
+            for record in records[1]:
+                admission_mask |= record[1]
+            mask = death_mask | admission_mask
+            
+            if in_pharmac:
+                counts['pharmac'] += 1
+            if death_mask & pd:
+                counts['mortality_pd'] += 1
+            
+            # Admission data shows PD but mortality data, without PD, shows they have died
+            if admission_mask & pd and no_pd_mortality:
+                counts['pd_not_noted_on_death'] += 1
+            
+            for i in xrange(len(conditions)):
+                if mask & (1 << i):
+                    counts['conditions'][i] += 1
+                    moh_conditions.add((i, nhi, int(in_pharmac)))
+                    if in_pharmac:
+                        counts['conditions_in_pharmac'][i] += 1
+            if in_pharmac and mask:
+                linked.add(nhi)
+            
+            ## Write out diagnoses to file
+            
+            if deaths or in_admissions:
+                if in_pharmac and not mask & pd:
+                    counts['other_in_pharmac'] += 1
+                
+                dwd.writerow({'nhi':nhi,
+                              'diagnosis':'PD' if mask & pd else 'Other'})
+        
+        f_out.close()
+        return counts, linked
+    
+    def merge(self, conditions, pharmac_runs, mortality, admissions,
+              directory=LINKAGE_DIR, sort_memory=256*2**20):
+        """ Link the partial results from each source and write out the outputs """
+        
+        pharmac = extsort.ExternalSort(os.path.join(directory, 'pharmac'), sort_memory, pharmac_runs)
+        mortality_sorters = [extsort.ExternalSort(os.path.join(directory, 'mortality_{}'.format(i)),
+                                                  sort_memory, result['runs'])
+                             for i, result in enumerate(mortality)]
+        admissions_sorter = extsort.ExternalSort(os.path.join(directory, 'admissions'),
+                                                 sort_memory, admissions['runs'])
+        moh_conditions = extsort.ExternalSort(os.path.join(directory, 'conditions'), sort_memory)
+        
+        counts, linked = self.link(conditions, pharmac, mortality_sorters, admissions_sorter,
+                                   moh_conditions)
+        pd_index = list(conditions).index('PD')
+        
+        pharmac_missing_mortality=OrderedDict((name, defaultdict(int)) for name in conditions)
+        pharmac_missing_admission=OrderedDict((name, defaultdict(int)) for name in conditions)
 
         fields =OrderedDict([('nhi',1),
                              ('age',2),
@@ -27,171 +514,164 @@ class MOHData:
                              ('sex',4),
                              ('ethnicity',5),
                              ('dhb',6),
-                             ('source',7)
+                             ('source',7),
+                             ('condition',8)
                              ])
         
         f_out_m = open('output/moh_missing_in_pharms.csv',"w")
         dwm = csv.DictWriter(f_out_m, delimiter=',',restval='NA',fieldnames=fields)
         dwm.writeheader()
         
-        # Read in NHIs from pharmac data
-        fname = 'output/classification.csv'
-        with open(fname, "r") as f:
-            records = csv.DictReader(f)
-            
-            for record in records:
-                #print record
-                if record['year_in_data']=='1':
-                    nhi_pharmac.add(record['nhi'])
-        
-        
-        ## Process mortality data
+        ## Mortality data
         
         deceased_count = 0
         pd_deceased_count = 0
-        no_pd_mortality = set()
         
-        files = ('raw/mos3358all/mos3358.csv',
-                 'raw/mos3464/mos3464.csv')
-        for fname in files:
-            with open(fname, "r") as f:
-                records = csv.DictReader(f)
+        mortality_hits = set()
+        
+        for result in mortality:
+            deceased_count += result['records']
+            pd_deceased_count += result['pd_records']
+            
+            # Only count each person once for each condition
+            for hit in result['hits']:
+                name = hit['condition']
+                nhi = hit['nhi']
+                if (name, nhi) in mortality_hits:
+                    continue
+                mortality_hits.add((name, nhi))
                 
-                for record in records:
-                    deceased_count +=1
-                    pd = False
-                    try:
-                        nhi = record['MAST_NHI']
-                    except KeyError:
-                        nhi = record['PRIM_HCU']
-                        
-                    for field in ('icda', #Underlying cause of death
-                                  'icdd', #Underlying cause of death
-                                  'icdf1','icdf2','icdf3','icdf4', #Other relevant diseases present
-                                  'icdg1','icdg2', #Other contributing causes
-                                  'icdc1','icdc2','icdj1','icdj2' #Cancer as non-contributing cause
-                                  ):
-                        nhi_all.add(nhi)
-                        
-                        try:
-                            value = record[field]
-                        except: 
-                            continue
-                        
-                        if 'G20' in value:
-                            pd = True
-                            nhi_pd.add(nhi)
-                            pd_deceased_count+=1
-                            if nhi not in nhi_pharmac:
-                                pharmac_missing_mortality[record['REGYR']]+=1
-                            #print "Parkinson's found: {}".format(record['MAST_NHI'])
-                            else:
-                                print "Parkinson's in mortality and Pharmac: {} {}".format(nhi,record['DOD'])
-                            if nhi not in nhi_pharmac:
-                                dhb = self.pharms.map_item(record['DHBDOM'],self.pharms.dhb_mapping)
-                                date = dateutil.parser.parse(record['DOD'],dayfirst=True)
-                                dwm.writerow({'age':record['AGE_AT_DEATH_YRS'],
-                                              'year':date.strftime("%Y"),
-                                              'nhi':nhi,
-                                              'sex':record['SEX'],
-                                              'source':'Mortality',
-                                              'dhb':dhb})
-                            
-                        
-                    if not pd:
-                        no_pd_mortality.add(nhi)
-            
-        print "Number deceased with PD: {} from a total of {} records".format(pd_deceased_count,deceased_count)
-
-
-        ## Process admission data
-
-        diagnoses=defaultdict(list)
-        admission_count = 0
-        pd_not_noted_on_death_count = set()
-        
-        diagfields = ['diag{:02.0f}'.format(i) for i in xrange(1,31)]
-        
-        fname = 'raw/pus9058all/pus9058.csv'
-        with open(fname, "r") as f:
-            records = csv.DictReader(f)
-            
-            for record in records:
-                admission_count +=1
-                nhi_all.add(record['MAST_NHI'])
-                for field in diagfields:
-                    diagnosis = record[field]
-                    if diagnosis:
-                        diagnoses[diagnosis].append(record['MAST_NHI'])
-                    if diagnosis == 'G20':
-                        if record['MAST_NHI'] not in nhi_pharmac:
-                            admission_date = dateutil.parser.parse(record['EVSTDATE'])
-                            pharmac_missing_admission[admission_date.year]+=1
-                            date = dateutil.parser.parse(record['EVSTDATE'],dayfirst=True)
-                            dwm.writerow({'age':record['AGE_DSCH'],
-                                          'year':date.strftime("%Y"),
-                                          'nhi':record['MAST_NHI'],
-                                          'sex':record['GENDER'],
-                                          'dhb':self.pharms.map_item(record['DHBDOM'],self.pharms.dhb_mapping),
-                                          'source':'Admissions'})
-                        if record['MAST_NHI'] in no_pd_mortality:
-                            pd_not_noted_on_death_count.add(record['MAST_NHI'])
-
-                        
-        print "Number admissions with PD: {} total from {} unique individuals (total of {} admissions)".format(len(diagnoses['G20']),
-                                                                                                               len(set(diagnoses['G20'])),
+                if nhi not in linked:
+                    pharmac_missing_mortality[name][hit['registration_year']]+=1
+                    dwm.writerow({'age':hit['age'],
+                                  'year':hit['year'],
+                                  'nhi':nhi,
+                                  'sex':hit['sex'],
+                                  'source':'Mortality',
+                                  'dhb':self.pharms.map_item(hit['dhb'],self.pharms.dhb_mapping),
+                                  'condition':name})
+                elif name == 'PD':
+                    print "Parkinson's in mortality and Pharmac: {} {}".format(nhi,hit['date'])
+            
+        print "Number deceased with PD: {} records from {} people, from a total of {} records".format(pd_deceased_count,
+                                                                                                    counts['mortality_pd'],
+                                                                                                    deceased_count)
+
+
+        ## Admission data
+
+        diagnoses = admissions['diagnoses']
+        admission_count = admissions['records']
+        
+        for hit in admissions['hits']:
+            name = hit['condition']
+            nhi = hit['nhi']
+            if nhi not in linked:
+                pharmac_missing_admission[name][hit['year']]+=1
+                dwm.writerow({'age':hit['age'],
+                              'year':hit['year'],
+                              'nhi':nhi,
+                              'sex':hit['sex'],
+                              'dhb':self.pharms.map_item(hit['dhb'],self.pharms.dhb_mapping),
+                              'source':'Admissions',
+                              'condition':name})
+        
+        f_out_m.close()
+        
+        distinct = diagnoses.distinct_counts()
+        
+        if isinstance(diagnoses, ApproximateDiagnosisCounts):
+            print "Unique individuals per ICD code are estimates, standard error about {:.1f}%".format(diagnoses.error*100)
+        
+        print "Number admissions with PD: {} total from {} unique individuals (total of {} admissions)".format(diagnoses.admission_count('G20'),
+                                                                                                               distinct.get('G20',0),
                                                                                                                admission_count)
         with open("output/admission_diagnoses.csv", "w") as f:
             
-            for code in sorted(diagnoses.keys()):
+            for code in diagnoses.codes():
                 output= "{},{},{}\n".format(code,
-                                              len(diagnoses[code]),
-                                              len(set(diagnoses[code]))
+                                              diagnoses.admission_count(code),
+                                              distinct[code]
                                               )
                 f.write(output)
         
-        nhi_pd = nhi_pd | set(diagnoses['G20'])
         
-        print "Number of unique PD identified from mortality/admissions: {}".format(len(nhi_pd))
+        print "Number of unique PD identified from mortality/admissions: {}".format(counts['conditions'][pd_index])
         
         
         
-        print "Total NHI in pharmac data: {}".format(len(nhi_pharmac))
-        print "Number of PD (identified from mortality/admissions) in pharmac: {}".format(len(nhi_pharmac & nhi_pd))
-        print "Number of other diagnoses (identified from mortality/admissions) in pharmac: {}".format(len(nhi_pharmac & (nhi_all - nhi_pd)))
-        print "Total PD (identified from mortality/admissions) not in pharmac: {}".format(len(nhi_pd-nhi_pharmac))
+        print "Total NHI in pharmac data: {}".format(counts['pharmac'])
+        print "Number of PD (identified from mortality/admissions) in pharmac: {}".format(counts['conditions_in_pharmac'][pd_index])
+        print "Number of other diagnoses (identified from mortality/admissions) in pharmac: {}".format(counts['other_in_pharmac'])
+        print "Total PD (identified from mortality/admissions) not in pharmac: {}".format(counts['conditions'][pd_index] -
+                                                                                          counts['conditions_in_pharmac'][pd_index])
         
-        print "Admission data shows PD, has died, but PD not shown in mortality data: {}".format(len(pd_not_noted_on_death_count))
+        print "Admission data shows PD, has died, but PD not shown in mortality data: {}".format(counts['pd_not_noted_on_death'])
         
+        for i, name in enumerate(conditions):
+            print "{}: {} identified from mortality/admissions, {} in pharmac".format(name,
+                                                                                      counts['conditions'][i],
+                                                                                      counts['conditions_in_pharmac'][i])
+            print "Missing in pharmac but in mortality by year"
+            print pharmac_missing_mortality[name]
+            print "Missing in pharmac but in admission by year"
+            print pharmac_missing_admission[name]
         
-        print "Missing in pharmac but in mortality by year"
-        print pharmac_missing_mortality
-        print "Missing in pharmac but in admission by year"
-        print pharmac_missing_admission
+        self.pharmac_missing_mortality = pharmac_missing_mortality
+        self.pharmac_missing_admission = pharmac_missing_admission
         
-        ## Write out diagnoses to file
+        ## Write out every death and admission with a condition, for looking up people
         
         fields =OrderedDict([('nhi',1),
-                             ('diagnosis',2),
-                             ('ethnicity',3),
+                             ('source',2),
+                             ('condition',3),
+                             ('date',4),
+                             ('year',5),
+                             ('age',6),
+                             ('sex',7),
+                             ('dhb',8),
                              ])
         
-        f_out = open('output/moh_diagnoses.csv',"w")
-        dwd = csv.DictWriter(f_out, delimiter=',',restval='NA',fieldnames=fields)
-        dwd.writeheader()
-        
-        for nhi in nhi_all:
+        with open('output/moh_events.csv',"w") as f:
+            dwe = csv.DictWriter(f, delimiter=',',restval='NA',fieldnames=fields,extrasaction='ignore')
+            dwe.writeheader()
             
-            data = {'nhi':nhi}
-            
-            if nhi in nhi_pd:
-                data['diagnosis'] = 'PD'
-            else:
-                data['diagnosis'] = 'Other'
+            for result in mortality + [admissions]:
+                for hit in result['hits']:
+                    dwe.writerow(dict(hit,
+                                      source=result['source'],
+                                      dhb=self.pharms.map_item(hit['dhb'],self.pharms.dhb_mapping)))
+        
+        ## Write out all conditions found for each NHI, by condition
+        
+        fields =OrderedDict([('nhi',1),
+                             ('condition',2),
+                             ('in_pharmac',3),
+                             ])
+        
+        names = list(conditions)
+        with open('output/moh_conditions.csv',"w") as f:
+            dwc = csv.DictWriter(f, delimiter=',',restval='NA',fieldnames=fields)
+            dwc.writeheader()
             
-            dwd.writerow(data)
+            for i, nhi, in_pharmac in moh_conditions.sorted():
+                dwc.writerow({'nhi':nhi,
+                              'condition':names[i],
+                              'in_pharmac':in_pharmac})
+        
+        for sorter in [pharmac, admissions_sorter, moh_conditions] + mortality_sorters:
+            sorter.clear()
         
 if __name__ == '__main__':
 
-    mortality = MOHData()
- 
\ No newline at end of file
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Process the MOH mortality and admission data')
+    parser.add_argument('--approximate-distinct', type=float, default=None, metavar='ERROR',
+                        help='Estimate the people with each ICD code in admission_diagnoses.csv, '
+                             'to about this relative standard error (e.g. 0.02), rather than count them')
+    sample.add_argument(parser)
+    args = parser.parse_args()
+    sample.from_arguments(args)
+    
+    mortality = MOHData(distinct_error=args.approximate_distinct)
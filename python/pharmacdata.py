@@ -4,14 +4,612 @@ import datetime
 import operator
 import sys,traceback
 import csv
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
+import numpy
+import os
 import sqlite3
 
-def dict_from_row(row):
-    return dict(zip(row.keys(), row))
+import extsort
+import sample
+
+date_cache = dict()
+
+def parse_date(date):
+    """ Parse a dd/mm/yyyy date, only parsing each distinct string once """
+    
+    try:
+        return date_cache[date]
+    except KeyError:
+        date_cache[date] = dateutil.parser.parse(date,dayfirst=True).date()
+        return date_cache[date]
+
+day_cache = dict()
+
+def format_day(day):
+    """ dd/mm/yyyy date of a day number, as in the raw data """
+    
+    try:
+        return day_cache[day]
+    except KeyError:
+        day_cache[day] = datetime.date.fromordinal(day).strftime('%d/%m/%Y')
+        return day_cache[day]
+
+class Demographics:
+    """ Dates of birth and death of each person as day numbers
+    
+    Only parsed for the first of a person's records (or if they change),
+    so ages and days after death are integer arithmetic.
+    """
+    
+    def __init__(self):
+        self.people = dict()
+    
+    def days(self, nhi, dob, dod):
+        """ Day numbers of birth and death (None if alive) from a record's dob and dod """
+        
+        try:
+            cached = self.people[nhi]
+            if cached[0] == dob and cached[1] == dod:
+                return cached[2], cached[3]
+        except KeyError:
+            pass
+        
+        dob_day = parse_date(dob).toordinal()
+        if dod != '':
+            dod_day = parse_date(dod).toordinal()
+        else:
+            dod_day = None
+        
+        self.people[nhi] = (dob, dod, dob_day, dod_day)
+        return dob_day, dod_day
+
+def dispensing_key(nhi, date_dispensed, pack_key, days_supply, daily_dose):
+    """ Hash of a dispensing, the same whichever extract and format it came from """
+    
+    try:
+        daily_dose = "{:g}".format(float(daily_dose))
+    except ValueError:
+        daily_dose = ''
+    
+    canonical = "|".join((nhi, date_dispensed.isoformat(), pack_key.strip(),
+                          days_supply.strip().lstrip('0'), daily_dose))
+    return sqlite3.Binary(hashlib.sha1(canonical).digest()[:16])
+
+class DuplicateIndex:
+    """ Dispensings already seen, to drop the same dispensing from overlapping extracts
+    
+    Kept on disk in the database so it isn't limited by memory. The same
+    dispensing more than once within an extract is kept, as it can be more
+    than one pack on a day, so only copies beyond the most in any one
+    extract are duplicates.
+    """
+    
+    def __init__(self, db, pairs=None):
+        self.db = db
+        
+        # Keep the keys of a load being resumed
+        if pairs is None:
+            self.db.execute('DROP TABLE IF EXISTS dispensing_keys')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS dispensing_keys
+                     (key blob PRIMARY KEY, dataset text, kept integer, 
+                      seen_dataset text, seen integer) WITHOUT ROWID''')
+        
+        # Number of duplicates for each (extract, extract first seen in)
+        self.pairs = defaultdict(int)
+        for pair, n in pairs or []:
+            self.pairs[tuple(pair)] = n
+    
+    def is_duplicate(self, key, dataset):
+        
+        row = self.db.execute('SELECT dataset, kept, seen_dataset, seen FROM dispensing_keys WHERE key=?',
+                              (key,)).fetchone()
+        
+        if row is None:
+            self.db.execute('INSERT INTO dispensing_keys VALUES (?,?,1,?,1)', (key, dataset, dataset))
+            return False
+        
+        first_dataset, kept, seen_dataset, seen = row
+        
+        if first_dataset == dataset:
+            self.db.execute('UPDATE dispensing_keys SET kept=?, seen=? WHERE key=?', (kept+1, seen+1, key))
+            return False
+        
+        # Count the copies in this extract
+        if seen_dataset != dataset:
+            seen = 0
+        seen += 1
+        
+        if seen > kept:
+            self.db.execute('UPDATE dispensing_keys SET kept=?, seen_dataset=?, seen=? WHERE key=?',
+                            (kept+1, dataset, seen, key))
+            return False
+        
+        self.db.execute('UPDATE dispensing_keys SET seen_dataset=?, seen=? WHERE key=?',
+                        (dataset, seen, key))
+        self.pairs[(dataset, first_dataset)] += 1
+        return True
+    
+    def write(self, fname):
+        
+        with open(fname, "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(['dataset','duplicate_of','records'])
+            for pair in sorted(self.pairs):
+                writer.writerow(list(pair) + [self.pairs[pair]])
+
+class Checkpoint:
+    """ Progress through the raw data, saved in the database with the records it covers
+    
+    The state is saved in the same transaction as the records inserted
+    since the last checkpoint, so the two always agree.
+    """
+    
+    def __init__(self, db):
+        self.db = db
+        self.db.execute('CREATE TABLE IF NOT EXISTS checkpoint (id integer PRIMARY KEY, state text)')
+    
+    def load(self):
+        row = self.db.execute('SELECT state FROM checkpoint WHERE id=1').fetchone()
+        if row is None:
+            return None
+        
+        # json gives unicode, the rest of the code uses str
+        def to_str(value):
+            if isinstance(value, unicode):
+                return value.encode('utf-8')
+            if isinstance(value, list):
+                return [to_str(item) for item in value]
+            if isinstance(value, dict):
+                return dict((to_str(key), to_str(item)) for key, item in value.iteritems())
+            return value
+        
+        return to_str(json.loads(row[0]))
+    
+    def save(self, state):
+        self.db.execute('INSERT OR REPLACE INTO checkpoint VALUES (1,?)', (json.dumps(state),))
+    
+    def clear(self):
+        self.db.execute('DELETE FROM checkpoint')
+
+# Why a record isn't in a cohort, in the order the rules are applied. A
+# record's reason code for a cohort is its position in this list
+REASONS = ('included','drug','nhi','duplicate','dod','age','single')
+INCLUDED, DRUG, NHI, DUPLICATE, DOD, AGE, SINGLE = range(len(REASONS))
+
+# Bits of each cohort's reason code in the reasons column of the audit
+REASON_BITS = 3
+
+EMPTY_NHI = ('','unknown')
+
+class ExclusionAudit:
+    """ Reason code of every raw record for each cohort
+    
+    Kept in the database and committed with the records and checkpoint, so
+    the numbers of records and people excluded for each reason are group-bys
+    of this table, and any exclusion can be traced back to the extract and
+    record it came from.
+    
+    There is one row per raw record, with the drug as its code in the drugs
+    table and the reason codes of all the cohorts packed into one integer,
+    REASON_BITS bits per cohort.
+    """
+    
+    def __init__(self, db, drugs, resume=False):
+        self.db = db
+        self.drugs = drugs
+        
+        if not resume:
+            self.db.execute('DROP TABLE IF EXISTS audit')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS audit
+                     (nhi text, dataset integer, record integer, year integer, date integer,
+                      drug integer, pack text, reasons integer,
+                      PRIMARY KEY (nhi, dataset, record)) WITHOUT ROWID''')
+    
+    @staticmethod
+    def reason(cohort):
+        """ Expression for the reason code of a cohort """
+        return '((reasons >> {}) & {})'.format(REASON_BITS*cohort, 2**REASON_BITS - 1)
+    
+    def add(self, rows):
+        self.db.executemany('INSERT INTO audit VALUES (?,?,?,?,?,?,?,?)', rows)
+    
+    def nhis(self, cohort, reason):
+        """ People with any record excluded from a cohort for a reason """
+        return set(row[0] for row in self.db.execute('SELECT DISTINCT nhi FROM audit WHERE {}=?'.format(
+                                                         self.reason(cohort)), (reason,)))
+    
+    def exclude_single(self, cohort, nhi):
+        self.db.execute('UPDATE audit SET reasons = reasons + ? WHERE nhi=? AND {}=?'.format(self.reason(cohort)),
+                        ((SINGLE - INCLUDED) << REASON_BITS*cohort, nhi, INCLUDED))
+    
+    def records(self, cohort):
+        """ Number of records with each reason code """
+        
+        records = [0]*len(REASONS)
+        for reason, n in self.db.execute('SELECT {0}, count(*) FROM audit GROUP BY {0}'.format(self.reason(cohort))):
+            records[reason] = n
+        return records
+    
+    def people(self, cohort):
+        """ Number of people, and the number removed for each reason code
+        
+        A person is only counted as removed for the first of drug, dod and
+        age they have any record excluded for. People with a missing NHI
+        aren't counted at all.
+        """
+        
+        row = self.db.execute('''SELECT count(*), ifnull(sum(drug),0), ifnull(sum(dod AND NOT drug),0),
+                                         ifnull(sum(age AND NOT drug AND NOT dod),0), ifnull(sum(single),0)
+                                  FROM (SELECT max({0}=?) AS drug, max({0}=?) AS dod,
+                                               max({0}=?) AS age, max({0}=?) AS single
+                                        FROM audit WHERE nhi NOT IN (?,?) GROUP BY nhi)'''.format(
+                                  self.reason(cohort)),
+                              (DRUG, DOD, AGE, SINGLE) + EMPTY_NHI).fetchone()
+        
+        people = [0]*len(REASONS)
+        people[DRUG], people[DOD], people[AGE], people[SINGLE] = tuple(row)[1:]
+        return row[0], people
+    
+    def by(self, cohort, field, reason=None):
+        """ Number of records for each value of a field, optionally only those with a reason code
+        
+        The field is a column of the audit table, or drug_group which is
+        looked up from the drug code.
+        """
+        
+        column = 'drug' if field == 'drug_group' else field
+        if reason is None:
+            rows = self.db.execute('SELECT {0}, count(*) FROM audit GROUP BY {0}'.format(column))
+        else:
+            rows = self.db.execute('SELECT {0}, count(*) FROM audit WHERE {1}=? GROUP BY {0}'.format(
+                                       column, self.reason(cohort)), (reason,))
+        
+        counts = defaultdict(int)
+        if field == 'drug_group':
+            drugs = self.drugs.values()
+            for drug, n in rows:
+                counts[drugs[drug][1]] += n
+        else:
+            counts.update(rows.fetchall())
+        return counts
+    
+    def excluded_drugs(self, cohort):
+        """ Drug and pack of the records excluded for the drug """
+        
+        drugs = self.drugs.values()
+        return set("{}-{}".format(drugs[drug][0], pack) for drug, pack in
+                   self.db.execute('SELECT DISTINCT drug, pack FROM audit WHERE {}=?'.format(self.reason(cohort)),
+                                   (DRUG,)))
+    
+    def single_months(self, cohort):
+        """ Number of people with only a single date of dispensing by the month of it """
+        
+        months = defaultdict(int)
+        for nhi, day in self.db.execute('SELECT nhi, min(date) FROM audit WHERE {}=? GROUP BY nhi'.format(
+                                            self.reason(cohort)), (SINGLE,)):
+            months[datetime.date.fromordinal(day).strftime("%Y-%m")] += 1
+        return months
+    
+    def write(self, fname, cohorts):
+        """ Records and people (with any record) for each cohort and reason """
+        
+        with open(fname, "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(['cohort','reason','records','people'])
+            for i, cohort in enumerate(cohorts):
+                for reason, records, people in self.db.execute(
+                        '''SELECT {0}, count(*), count(DISTINCT CASE WHEN nhi NOT IN (?,?) THEN nhi END)
+                           FROM audit GROUP BY {0} ORDER BY {0}'''.format(self.reason(i)), EMPTY_NHI):
+                    writer.writerow([cohort.name, REASONS[reason], records, people])
+
+PHARMAC_DB = 'output/pharmac.db'
+
+def partition_fname(fname, part):
+    """ File of a partition of the dispensings, e.g. output/pharmac_3.db """
+    return '{}_{}.db'.format(os.path.splitext(fname)[0], part)
+
+def partition_files(fname=PHARMAC_DB):
+    """ Files of the dispensings partitions of a database, one reader can be used for each """
+    
+    conn = sqlite3.connect(fname)
+    files = [row[0] for row in conn.execute('SELECT fname FROM partitions ORDER BY part')]
+    conn.close()
+    return files
+
+class CodeTable:
+    """ Integer codes for the distinct values of one or more text columns, kept in a lookup table """
+    
+    def __init__(self, db, name, columns, resume=False):
+        self.db = db
+        self.name = name
+        self.columns = columns
+        
+        if not resume:
+            self.db.execute('DROP TABLE IF EXISTS {}'.format(name))
+        self.db.execute('CREATE TABLE IF NOT EXISTS {} (code integer PRIMARY KEY, {})'.format(
+                            name, ', '.join('{} text'.format(column) for column in columns)))
+        
+        self.codes = dict()
+        for row in self.db.execute('SELECT * FROM {}'.format(name)):
+            self.codes[tuple(row)[1:]] = row[0]
+    
+    def code(self, *value):
+        
+        try:
+            return self.codes[value]
+        except KeyError:
+            self.codes[value] = len(self.codes)
+            self.db.execute('INSERT INTO {} VALUES ({})'.format(self.name, ','.join('?'*(len(value)+1))),
+                            (self.codes[value],) + value)
+            return self.codes[value]
+    
+    def values(self):
+        """ Values of each code, as a list indexed by the code """
+        
+        values = [None]*len(self.codes)
+        for value, code in self.codes.iteritems():
+            values[code] = value if len(value) > 1 else value[0]
+        return values
+
+# Columns of the dispensings table, and fields of the records when staged by sorting
+DISPENSING_COLUMNS = ('nhi','date','dataset','record','birthdate','date_of_death','sex','ethnicity',
+                      'dhb','drug','pack','dose_mg','days_supply','provider','cohorts')
+
+class DispensingStore:
+    """ The included dispensings, partitioned by a hash of the NHI
+    
+    Each partition is a separate SQLite file with its own dispensings table.
+    They are attached to the main database, so the records, audit and
+    checkpoint are still committed together. All of a person's dispensings
+    are in one partition, so the export (or any query by person) can run a
+    process per partition. The partitions split people, not years, so a new
+    extract adds to all of them.
+    
+    Dates are day numbers, dose and days supply are numbers (NULL if not
+    known) and the drug, ethnicity, DHB and prescriber are codes of the
+    lookup tables drugs, ethnicities, dhbs and providers in the main database. The table is clustered
+    on (nhi, date), with the extract and record number to tell apart
+    dispensings on the same day, so a person's dispensings in date order are
+    a range of the table.
+    """
+    
+    def __init__(self, db, fname=PHARMAC_DB, partitions=8, resume=False):
+        self.db = db
+        self.files = [partition_fname(fname, part) for part in xrange(partitions)]
+        
+        # SQLite allows up to 10 attached databases by default
+        for part, part_fname in enumerate(self.files):
+            self.db.execute('ATTACH DATABASE ? AS part{}'.format(part), (part_fname,))
+        
+        # Create tables, unless resuming a load
+        if not resume:
+            # Unpartitioned table of earlier versions
+            self.db.execute('DROP TABLE IF EXISTS dispensings')
+            
+            self.db.execute('DROP TABLE IF EXISTS partitions')
+            self.db.execute('CREATE TABLE partitions (part integer PRIMARY KEY, fname text)')
+            self.db.executemany('INSERT INTO partitions VALUES (?,?)', enumerate(self.files))
+            
+            for part in xrange(partitions):
+                self.db.execute('DROP TABLE IF EXISTS part{}.dispensings'.format(part))
+                self.db.execute('''CREATE TABLE part{}.dispensings
+                             (nhi text, date integer, dataset integer, record integer,
+                              birthdate integer, date_of_death integer, sex text, ethnicity integer,
+                              dhb integer, drug integer, pack text, dose_mg real, days_supply integer,
+                              provider integer, cohorts integer,
+                              PRIMARY KEY (nhi, date, dataset, record)) WITHOUT ROWID'''.format(part))
+        
+        self.drugs = CodeTable(db, 'drugs', ('drug','drug_group'), resume)
+        self.ethnicities = CodeTable(db, 'ethnicities', ('ethnicity',), resume)
+        self.dhbs = CodeTable(db, 'dhbs', ('dhb',), resume)
+        self.providers = CodeTable(db, 'providers', ('provider',), resume)
+        
+        self.part_of = dict()
+    
+    def part(self, nhi):
+        """ Partition of a person """
+        
+        try:
+            return self.part_of[nhi]
+        except KeyError:
+            # Salted, so it doesn't follow the hash --sample keeps people by, which would put
+            # everyone in a small sample into the first partition
+            digest = hashlib.md5('partition:' + nhi.strip().upper()).hexdigest()
+            self.part_of[nhi] = int(digest[:8], 16) % len(self.files)
+            return self.part_of[nhi]
+    
+    def add(self, summaries):
+        """ Insert dispensings into the partition of each one's NHI """
+        
+        by_part = defaultdict(list)
+        for summary in summaries:
+            by_part[self.part(summary['nhi'])].append(summary)
+        
+        for part in sorted(by_part):
+            self.db.executemany('INSERT INTO part{}.dispensings '.format(part) + 
+                            '(nhi, date, dataset, record, birthdate, date_of_death, sex, ethnicity, ' +
+                            'dhb, drug, pack, dose_mg, days_supply, provider, cohorts) ' +
+                            'VALUES (:nhi, :date, :dataset, :record, :birthdate, :date_of_death, :sex, :ethnicity, ' +
+                            ':dhb, :drug, :pack, :dose_mg, :days_supply, :provider, :cohorts);', by_part[part])
+    
+    def lookups(self):
+        """ Values of the codes, for decoding in another process """
+        return {'drugs':self.drugs.values(),
+                'ethnicities':self.ethnicities.values(),
+                'dhbs':self.dhbs.values(),
+                'providers':self.providers.values()}
+
+def decode(dispensing, lookups, missing_dose):
+    """ A row of a dispensings partition as a row of the exported records """
+    
+    drug, drug_group = lookups['drugs'][dispensing['drug']]
+    
+    if dispensing['dose_mg'] is not None:
+        dose_mg = "{:0.2f}".format(dispensing['dose_mg'])
+    elif dispensing['pack'] in missing_dose:
+        dose_mg = 'NA-{}'.format(dispensing['pack'])
+    else:
+        dose_mg = 'NA'
+    
+    return {'nhi':dispensing['nhi'],
+            'age':'{:0.1f}'.format((dispensing['date']-dispensing['birthdate'])/365.0),
+            'sex':dispensing['sex'],
+            'birthdate':format_day(dispensing['birthdate']),
+            'date_of_death':format_day(dispensing['date_of_death']) if dispensing['date_of_death'] is not None else '',
+            'date':format_day(dispensing['date']),
+            'ethnicity':lookups['ethnicities'][dispensing['ethnicity']],
+            'dhb':lookups['dhbs'][dispensing['dhb']],
+            'drug':drug,
+            'drug_group':drug_group,
+            'dose_mg':dose_mg,
+            'days_supply':dispensing['days_supply'] if dispensing['days_supply'] is not None else 'NA',
+            'provider_id':lookups['providers'][dispensing['provider']],
+            }
+
+def export_people(people, cohorts, lookups, missing_dose):
+    """ Export each cohort's people, from (nhi, dispensings in date order) for each person
+    
+    Returns the number of people and records exported for each cohort, and
+    the NHIs excluded from each for having a single date of dispensing.
+    """
+    
+    n_people = [0]*len(cohorts)
+    n_records = [0]*len(cohorts)
+    single = [[] for cohort in cohorts]
+    
+    for nhi, all_dispensings in people:
+        all_dispensings = list(all_dispensings)
+        
+        for i, cohort in enumerate(cohorts):
+            sorted_dispensings = [dispensing for dispensing in all_dispensings 
+                                  if dispensing['cohorts'] & cohort.bit]
+            if not sorted_dispensings:
+                continue
+            
+            # Count number of unique dates
+            dates = set()
+            for dispensing in sorted_dispensings:
+                dates.add(dispensing['date'])
+            
+            # Export data if dispensings on 2 or more dates
+            if len(dates) > 1 or not cohort.exclude_single:
+                n_people[i] += 1
+                for dispensing in sorted_dispensings:
+                    n_records[i] +=1
+                    cohort.dwp.writerow(decode(dispensing, lookups, missing_dose))
+            else:
+                for dispensing in sorted_dispensings:
+                    exported = decode(dispensing, lookups, missing_dose)
+                    if dispensing['date_of_death'] is not None:
+                        exported['dod_delta'] = dispensing['date_of_death'] - dispensing['date']
+                    cohort.dwsd.writerow(exported)
+                single[i].append(nhi)
+    
+    return zip(n_people, n_records), single
+
+def export_partition(arguments):
+    """ Export each cohort's people in a partition, to files of their own """
+    
+    part, fname, cohorts, fields, single_fields, lookups, missing_dose = arguments
+    
+    conn = sqlite3.connect(fname)
+    conn.row_factory = sqlite3.Row
+    
+    for cohort in cohorts:
+        cohort.open(fields, single_fields, part)
+    
+    # Everyone's dispensings in date order, in one pass through the table
+    rows = conn.execute("SELECT * FROM dispensings ORDER BY nhi, date, dataset, record")
+    exported = export_people(itertools.groupby(rows, operator.itemgetter('nhi')),
+                             cohorts, lookups, missing_dose)
+    
+    for cohort in cohorts:
+        cohort.close()
+    conn.close()
+    
+    return exported
+
+def merge_partitions(fname, parts):
+    """ Merge the files exported from each partition, all in NHI order, into one """
+    
+    files = [open('{}.{}'.format(fname, part)) for part in xrange(parts)]
+    readers = [csv.reader(f) for f in files]
+    
+    with open(fname, "w") as f:
+        writer = csv.writer(f)
+        
+        headers = [reader.next() for reader in readers]
+        writer.writerow(headers[0])
+        
+        # Each person is in only one partition, so order by NHI then the partition's order
+        def keyed(part, reader):
+            for i, row in enumerate(reader):
+                yield row[0], part, i, row
+        
+        for nhi, part, i, row in heapq.merge(*[keyed(part, reader) for part, reader in enumerate(readers)]):
+            writer.writerow(row)
+    
+    for part, part_file in enumerate(files):
+        part_file.close()
+        os.remove('{}.{}'.format(fname, part))
+
+class Cohort:
+    """ Which of the dispensings to include, with its own outputs
+    
+    Several cohorts can be produced from one pass over the raw data, e.g.
+    
+        PharmacData(NEW_DATASETS, cohorts=[
+            Cohort('all', 'output/included_records_pd_protection.csv'),
+            Cohort('over20', 'output/included_records_over20.csv', min_age=20),
+            Cohort('with_single', 'output/included_records_with_single.csv', exclude_single=False)])
+    """
+    
+    def __init__(self, name, outfname, min_age = None, exclude_drugs = True, 
+                 exclude_single = True, single_fname = None):
+        
+        self.name = name
+        self.outfname = outfname
+        self.min_age = min_age
+        self.exclude_drugs = exclude_drugs
+        self.exclude_single = exclude_single
+        self.single_fname = single_fname
+        
+        # Set by PharmacData, the bit for this cohort in the cohorts column of the database
+        self.bit = 1
+        
+        # Counted on export, to check against the exclusion audit
+        self.n_final_people = 0
+        self.n_final_records = 0
+    
+    def open(self, fields, single_fields, part = None):
+        """ Open the output files, or those for one partition of the dispensings """
+        
+        suffix = '' if part is None else '.{}'.format(part)
+        
+        self.f_out = open(self.outfname+suffix,"w")
+        self.dwp = csv.DictWriter(self.f_out, delimiter=',',restval='NA',fieldnames=fields,
+                                  extrasaction='ignore')
+        self.dwp.writeheader()
+        
+        self.fsd_out = open(self.single_fname+suffix,"w")
+        self.dwsd = csv.DictWriter(self.fsd_out, delimiter=',',restval='NA',fieldnames=single_fields,
+                                   extrasaction='ignore')
+        self.dwsd.writeheader()
+    
+    def close(self):
+        self.f_out.close()
+        self.fsd_out.close()
 
 class PharmacData:
     
-    def __init__(self, datasets = None, outfname = None, exclude_under_20 = True):
+    def __init__(self, datasets = None, outfname = None, exclude_under_20 = True,
+                 deduplicate = True, resume = False, checkpoint_every = 200000,
+                 cohorts = None, batch_size = 10000, partitions = 8, processes = None,
+                 staging = 'sqlite', sort_memory = 256*2**20):
         
 
         
@@ -19,20 +617,59 @@ class PharmacData:
         self.outfname = outfname
         self.exclude_under_20 = exclude_under_20
         
+        # Without a list of cohorts, a single cohort from outfname and exclude_under_20
+        if cohorts is None:
+            cohorts = [Cohort('default', outfname, 
+                              min_age = 20 if exclude_under_20 else None,
+                              single_fname = 'output/single_dispensing.csv')]
+        for i, cohort in enumerate(cohorts):
+            cohort.bit = 1 << i
+            if cohort.single_fname is None:
+                cohort.single_fname = 'output/single_dispensing_{}.csv'.format(cohort.name)
+        self.cohorts = cohorts
         
-        self.dbconn = sqlite3.connect('output/pharmac.db')
-        self.dbconn.row_factory = sqlite3.Row
+        self.deduplicate = deduplicate
+        self.checkpoint_every = checkpoint_every
+        self.batch_size = batch_size
+        self.processes = processes
+        self.resume_state = None
         
-        self.db = self.dbconn.cursor()
-
-        # Create table
-        self.db.execute('DROP TABLE IF EXISTS dispensings')
+        # Included records are grouped by person either in the database ('sqlite'), or by an
+        # external sort on disk ('sort'), which is faster but leaves the database without them
+        if staging not in ('sqlite','sort'):
+            raise ValueError("Staging must be 'sqlite' or 'sort', not {}".format(staging))
+        self.staging = staging
+        self.sorter = None
         
-        self.db.execute('''CREATE TABLE dispensings
-                     (nhi text, birthdate text, date_of_death text, age real, sex text,
-                      ethnicity text, dhb text, date text, drug text, drug_group text, dose_mg text, 
-                      days_supply text)''')
-        self.db.execute('''CREATE INDEX Idx1 ON dispensings(nhi)''')
+        
+        # Without datasets only the mappings are used, so leave any existing database alone
+        if datasets is not None:
+            self.dbconn = sqlite3.connect(PHARMAC_DB)
+            self.dbconn.row_factory = sqlite3.Row
+            
+            self.db = self.dbconn.cursor()
+            
+            self.checkpoint = Checkpoint(self.db)
+            if resume:
+                self.resume_state = self.checkpoint.load()
+                if self.resume_state is None:
+                    print "No checkpoint to resume from, starting from the beginning"
+                elif [dataset['filename'] for dataset in datasets] != self.resume_state['datasets'] or \
+                        len(cohorts) != len(self.resume_state['cohorts']) or \
+                        partitions != self.resume_state.get('partitions') or \
+                        staging != self.resume_state.get('staging', 'sqlite'):
+                    print "Checkpoint is for different datasets, cohorts, partitions or staging, starting from the beginning"
+                    self.resume_state = None
+            
+            if self.resume_state is None:
+                self.checkpoint.clear()
+            
+            self.store = DispensingStore(self.db, PHARMAC_DB, partitions, resume = self.resume_state is not None)
+            self.dbconn.commit()
+            
+            if staging == 'sort':
+                self.sorter = extsort.ExternalSort('output/staging', sort_memory,
+                                                   runs = self.resume_state['runs'] if self.resume_state else None)
         
         # Map from ethnic ID to ethnicity
         self.ethnic_mapping = {
@@ -186,7 +823,10 @@ class PharmacData:
     def process_raw(self):
         
         doderrors_file = 'output/disepensing_after_dod.csv'
-        singledisp_file = 'output/single_dispensing.csv'
+        duplicates_file = 'output/duplicate_dispensings.csv'
+        exclusions_file = 'output/exclusions.csv'
+        
+        cohorts = self.cohorts
         
         # Processed records file
         fields =[('nhi',1),
@@ -200,21 +840,15 @@ class PharmacData:
                  ('drug',5),
                  ('drug_group',6),
                  ('dose_mg',7),
-                 ('days_supply',8)
+                 ('days_supply',8),
+                 ('provider_id',9)
                  ]
         
-        f_out = open(self.outfname,"w")
-        dwp = csv.DictWriter(f_out, delimiter=',',restval='NA',fieldnames=OrderedDict(fields))
-        dwp.writeheader()
-        
-        # Processed records file
-        fields +=[
-                 ('dod_delta',9)
-                 ]
+        # Single dispensing file has the days from dispensing to death as well
+        single_fields = fields + [('dod_delta',10)]
         
-        fsd_out = open(singledisp_file,"w")
-        dwsd = csv.DictWriter(fsd_out, delimiter=',',restval='NA',fieldnames=OrderedDict(fields))
-        dwsd.writeheader()
+        record_fields = OrderedDict(fields)
+        single_record_fields = OrderedDict(single_fields)
         
         fields =OrderedDict([('nhi',1),
                      ('birthdate',2),
@@ -227,35 +861,216 @@ class PharmacData:
                      ('drug',9),
                      ])
         
-        dwd = csv.DictWriter(open(doderrors_file,"w"), delimiter=',',restval='NA',fieldnames=fields)
-        dwd.writeheader()
+        # Where the load got to, from the checkpoint if resuming
+        saved = self.resume_state or dict()
+        
+        if saved:
+            # Drop anything written after the checkpoint
+            fdod = open(doderrors_file,"r+")
+            fdod.truncate(saved['doderrors_size'])
+            fdod.seek(0,2)
+            dwd = csv.DictWriter(fdod, delimiter=',',restval='NA',fieldnames=fields)
+        else:
+            fdod = open(doderrors_file,"w")
+            dwd = csv.DictWriter(fdod, delimiter=',',restval='NA',fieldnames=fields)
+            dwd.writeheader()
      
         
-        dispensings = defaultdict(list)
+        demographics = Demographics()
         
-        n_excluded_records_nhi = 0
-        n_excluded_records_age = 0
-        n_excluded_records_dod = 0
-        n_excluded_records_drug = 0
+        if self.deduplicate:
+            duplicates = DuplicateIndex(self.db, saved.get('duplicate_pairs'))
         
-        n_records = 0
-        people = set()
+        # Reason each record is excluded from each cohort
+        audit = ExclusionAudit(self.db, self.store.drugs, resume = bool(saved))
         
-        excluded_age = set()
-        excluded_age_dob = set()
-        excluded_dod = set()
-        excluded_drug = set()
+        # People with a record excluded for age, as the rest of their records are excluded too
+        age_excluded = [audit.nhis(i, AGE) for i in xrange(len(cohorts))]
         
-        excluded_drug_names = set()
-        missing_dose = set()
+        bits = numpy.array([cohort.bit for cohort in cohorts])
+        reason_shifts = REASON_BITS*numpy.arange(len(cohorts))
         
-        total_records_by_year = defaultdict(int)
-        missing_nhi_by_year = defaultdict(int)
+        missing_dose = set(saved.get('missing_dose', []))
         
-        missing_by_drug = defaultdict(int)
-        total_by_drug = defaultdict(int)
+        def save_checkpoint(dataset_index, offset, record_number):
+            """ Commit the records so far along with where they were read up to """
+            
+            fdod.flush()
+            
+            # Sorted records are saved as runs on disk
+            if self.sorter is not None:
+                self.sorter.spill()
+            
+            self.checkpoint.save({'datasets':[dataset['filename'] for dataset in self.datasets],
+                                  'dataset':dataset_index,
+                                  'offset':offset,
+                                  'record':record_number,
+                                  'doderrors_size':fdod.tell(),
+                                  'cohorts':[cohort.name for cohort in cohorts],
+                                  'partitions':len(self.store.files),
+                                  'staging':self.staging,
+                                  'runs':self.sorter.runs if self.sorter is not None else [],
+                                  'duplicate_pairs':duplicates.pairs.items() if self.deduplicate else [],
+                                  'missing_dose':list(missing_dose)})
+            self.dbconn.commit()
+        
+        def process_batch(dataset_index, dataset, batch):
+            """ Apply the exclusion rules to a batch of records as masks, then store the included ones
+            
+            The rules are applied in the order of REASONS, each only to the
+            records not already excluded from a cohort, so a record's reason
+            code for a cohort is the first rule it fails.
+            """
+            
+            n = len(batch['raw'])
+            nhi = numpy.array(batch['nhi'])
+            date_day = numpy.array(batch['date_day'])
+            
+            reason = numpy.zeros((len(cohorts), n), dtype=int)
+            
+            # Only include if antiparkinson's (in cohorts that exclude the other drugs)
+            excluded_drug = numpy.in1d(numpy.array(batch['drug']), self.excluded_drugs)
+            for i, cohort in enumerate(cohorts):
+                if cohort.exclude_drugs:
+                    reason[i][excluded_drug] = DRUG
+            
+            # The rest of the record level rules are the same for every cohort, so are
+            # only checked for records still in at least one
+            
+            # If NHI is empty exclude
+            reason[(reason == INCLUDED) & numpy.in1d(nhi, EMPTY_NHI)] = NHI
+            
+            # If already had from another extract exclude. Depends on the records before,
+            # so checked in order
+            if self.deduplicate:
+                duplicate = numpy.zeros(n, dtype=bool)
+                for j in numpy.flatnonzero((reason == INCLUDED).any(axis=0)):
+                    record = batch['raw'][j]
+                    key = dispensing_key(batch['nhi'][j], batch['date_dispensed'][j], batch['drug_id'][j],
+                                         record['DAYS_SUPPLY'], record['DAILY_DOSE'])
+                    duplicate[j] = duplicates.is_duplicate(key, dataset['filename'])
+                reason[(reason == INCLUDED) & duplicate] = DUPLICATE
+            
+            # Only have age if have NHI
+            checked = numpy.flatnonzero((reason == INCLUDED).any(axis=0))
+            dob_day = numpy.zeros(n, dtype=int)
+            dod_day = numpy.zeros(n, dtype=int)
+            died = numpy.zeros(n, dtype=bool)
+            for j in checked:
+                record = batch['raw'][j]
+                dob_day[j], dod = demographics.days(batch['nhi'][j], record['dob'], record[dataset['dod']])
+                if dod is not None:
+                    dod_day[j] = dod
+                    died[j] = True
+            age = (date_day-dob_day)/365.0
+            
+            # if DOD is before dispensing date obviously an error
+            after_dod = died & (dod_day < date_day)
+            for j in numpy.flatnonzero(after_dod):
+                record = batch['raw'][j]
+                data = {'nhi':batch['nhi'][j],
+                        'birthdate':record['dob'],
+                        'date':record['DATE_DISPENSED'],
+                        'dod':record[dataset['dod']],
+                        'days_after_dod':date_day[j]-dod_day[j],
+                        'dispenser_fee':record['DISPENSING_FEE_VALUE'],
+                        'subsidy_value':record['RETAIL_SUBSIDY'],
+                        'provider_id': record['PROVIDER_NUMBER'],
+                        'drug':batch['drug'][j],
+                        }
+                dwd.writerow(data)
+            reason[(reason == INCLUDED) & after_dod] = DOD
+            
+            # If younger than the cohort's minimum age exclude, along with the rest of
+            # the person's records from then on
+            for i, cohort in enumerate(cohorts):
+                if cohort.min_age is None:
+                    continue
+                
+                reached = reason[i] == INCLUDED
+                young = numpy.flatnonzero(reached & (age < cohort.min_age))
+                
+                excluded = reached & numpy.array([person in age_excluded[i] for person in batch['nhi']],
+                                                 dtype=bool)
+                if len(young):
+                    # First young record of each person in the batch
+                    young_nhis, first = numpy.unique(nhi[young], return_index=True)
+                    k = numpy.searchsorted(young_nhis, nhi).clip(max=len(young_nhis)-1)
+                    excluded |= reached & (young_nhis[k] == nhi) & (numpy.arange(n) >= young[first][k])
+                    age_excluded[i].update(young_nhis.tolist())
+                
+                reason[i][excluded] = AGE
+            
+            # Reason codes of all the cohorts in one integer
+            reasons = (reason << reason_shifts[:,numpy.newaxis]).sum(axis=0)
+            drug_codes = [self.store.drugs.code(drug, drug_group)
+                          for drug, drug_group in zip(batch['drug'], batch['drug_group'])]
+            audit.add((batch['nhi'][j], dataset_index, batch['record'][j], batch['date_dispensed'][j].year,
+                       batch['date_day'][j], drug_codes[j], batch['drug_id'][j], code)
+                      for j, code in enumerate(reasons.tolist()))
+            
+            # Bit for each cohort a record is included in
+            included = ((reason == INCLUDED)*bits[:,numpy.newaxis]).sum(axis=0)
+            
+            summaries = []
+            for j in numpy.flatnonzero(included):
+                record = batch['raw'][j]
+                
+                ethnicity = self.map_item(record['ETHNICGP'],self.ethnic_mapping)
+                dhb = self.map_item(record['DHB_CLAIMANT'],self.dhb_mapping)
+                
+                # Daily dose in mg, None if not known
+                try:
+                    dose_mg = float(self.map_item(record['DIM_FORM_PACK_SUBSIDY_KEY'],self.dose_mapping))
+                    days = record['DAILY_DOSE']
+                    if days != '':
+                        dose_mg *= float(days)
+                    else:
+                        dose_mg = None
+                except ValueError:
+                    missing_dose.add(record['DIM_FORM_PACK_SUBSIDY_KEY'])
+                    dose_mg = None
+                
+                # None if not known (0 or missing)
+                try:
+                    days_supply = int(record['DAYS_SUPPLY']) or None
+                except ValueError:
+                    days_supply = None
+                
+                summary = {'nhi':batch['nhi'][j],
+                           'date':batch['date_day'][j],
+                           'dataset':dataset_index,
+                           'record':batch['record'][j],
+                           'birthdate':int(dob_day[j]),
+                           'date_of_death':int(dod_day[j]) if died[j] else None,
+                           'sex':record['GENDER'],
+                           'ethnicity':self.store.ethnicities.code(ethnicity),
+                           'dhb':self.store.dhbs.code(dhb),
+                           'drug':self.store.drugs.code(batch['drug'][j], batch['drug_group'][j]),
+                           'pack':batch['drug_id'][j],
+                           'dose_mg':dose_mg,
+                           'days_supply':days_supply,
+                           'provider':self.store.providers.code(record['PROVIDER_NUMBER']),
+                           'cohorts':int(included[j])
+                           }
+                summaries.append(summary)
+            
+            ## OLD: store in a dictionary
+            #dispensings[nhi].append(summary)
+            
+            # New: Put in a DB (or the sort), with a bit for each cohort it is included in:
+            if self.sorter is not None:
+                for summary in summaries:
+                    self.sorter.add(tuple(summary[column] for column in DISPENSING_COLUMNS))
+            else:
+                self.store.add(summaries)
         
-        for dataset in self.datasets:
+        for dataset_index, dataset in enumerate(self.datasets):
+            
+            # Files already loaded before the checkpoint
+            if dataset_index < saved.get('dataset', 0):
+                continue
+            
             print "Processing file {}".format(dataset['filename']) 
             with open("raw/"+dataset['filename'], "r") as f:
             
@@ -266,18 +1081,32 @@ class PharmacData:
                 for key in keys: 
                     drug_names[key['DIM_FORM_PACK_SUBSIDY_KEY']]=key['CHEMICAL_NAME']
                 
-                records = csv.DictReader(f)
-                row = 1
+                # Read line by line (not with read ahead) so the position in the file is known
+                lines = iter(f.readline, '')
+                header = csv.reader(lines).next()
+                
+                # Number of the record in the file, for the audit
+                record_number = 0
+                
+                if dataset_index == saved.get('dataset') and saved['offset']:
+                    print "Resuming from byte {}".format(saved['offset'])
+                    f.seek(saved['offset'])
+                    record_number = saved['record']
+                
+                since_checkpoint = 0
+                batch = defaultdict(list)
+                
+                records = csv.DictReader(lines, fieldnames=header)
                 for record in records:
                     
+                    record_number += 1
                     
-                    ## Testing - only process first 10000
-                    #if row > 10000:
-                    #    break
-                    #else:
-                    #    row += 1
+                    # Only people in the sample (python pharmacdata.py --sample 0.01 for a quick run)
+                    nhi = record[dataset['nhi']]
+                    if not sample.keep(nhi):
+                        continue
     
-                    ## Extract data and handle exclusion cases at the records level
+                    ## Extract data, the exclusions are applied to a batch of records at a time
                     
                     drug_id = record['DIM_FORM_PACK_SUBSIDY_KEY']
                     #drug = self.map_item(drug_id,self.drugid_mapping)
@@ -285,228 +1114,168 @@ class PharmacData:
                     drug_group = self.map_item(drug,self.drug_mapping)
                     if drug_group == 'ATTN':
                         drug_group = drug
-                    nhi = record[dataset['nhi']]
-                    date = record['DATE_DISPENSED']
-                    date_py = dateutil.parser.parse(date,dayfirst=True)
-
-
+                    date_dispensed = parse_date(record['DATE_DISPENSED'])
                     
                     ## Testing between prim_hcu and nhi
                     #nhi2 = record["prim_hcu"]
                     #if nhi!= nhi2:
                     #    nhi_diff[nhi2].add(nhi)
                     
-                    n_records += 1
-                    total_records_by_year[date_py.year]+=1
-                    total_by_drug[drug_group]+=1
-                    
-                    # Record NHI if known
-                    if nhi not in ('','unknown'):
-                        people.add(nhi)
-                    
-                    # Only include if antiparkinson's
-                    if drug in self.excluded_drugs:
-                        excluded_drug.add(nhi)
-                        n_excluded_records_drug += 1
-                        try:
-                            excluded_drug_names.add("{}-{}".format(drug,drug_id))
-                        except:
-                            excluded_drug_names.add("{}".format(drug_id))
-                        continue
-                 
-                    
-                    # If NHI is empty exclude
-                    if nhi in ('','unknown'):
-                        n_excluded_records_nhi +=1
-                        missing_nhi_by_year[date_py.year]+=1
-                        missing_by_drug[drug_group]+=1
-                        #print record
-                        continue
-                    
-                    # Only have age if have NHI
-                    dob = record['dob']
-                    age = (date_py-dateutil.parser.parse(dob,dayfirst=True)).days/365.0                    
-                    
-                    # if DOD is before dispensing date obviously an error
-                    dod = record[dataset['dod']]
-                    if dod != '':
-                        dod_py = dateutil.parser.parse(dod,dayfirst=True)
-                        if dod_py < date_py:
-                            data = {'nhi':nhi,
-                                    'birthdate':record['dob'],
-                                    'date':date,
-                                    'dod':dod,
-                                    'days_after_dod':(date_py-dod_py).days,
-                                    'dispenser_fee':record['DISPENSING_FEE_VALUE'],
-                                    'subsidy_value':record['RETAIL_SUBSIDY'],
-                                    'provider_id': record['PROVIDER_NUMBER'],
-                                    'drug':drug,
-                                    }
-                            dwd.writerow(data)
-                            excluded_dod.add(nhi)
-                            n_excluded_records_dod +=1
-                            continue
-                            
-                    # If younger than 20 years exclude
-                    if nhi in excluded_age:
-                        n_excluded_records_age +=1
-                        continue
-                    
-                    if self.exclude_under_20 and age < 20:
-                        excluded_age.add(nhi)
-                        excluded_age_dob.add((nhi,dob))
-                        n_excluded_records_age +=1
-                        continue
-                    
-                    ethnicity = self.map_item(record['ETHNICGP'],self.ethnic_mapping)
-                    dhb = self.map_item(record['DHB_CLAIMANT'],self.dhb_mapping)
-                    
-                    
-
-                    
-                    
-                    try:
-                        dose_mg = float(self.map_item(record['DIM_FORM_PACK_SUBSIDY_KEY'],self.dose_mapping))
-                        days = record['DAILY_DOSE']
-                        if days != '':
-                            dose_mg *= float(days)
-                            dose_mg = "{:0.2f}".format(dose_mg)
-                        else:
-                            dose_mg = 'NA'
-                    except ValueError:
-                        missing_dose.add(record['DIM_FORM_PACK_SUBSIDY_KEY'])
-                        dose_mg = 'NA-{}'.format(record['DIM_FORM_PACK_SUBSIDY_KEY'])
-                    
-                    days_supply = record['DAYS_SUPPLY']
-                    if days_supply == '0':
-                        days_supply = 'NA'
-                    
-                    summary = {'nhi':nhi,
-                               'age':'{:0.1f}'.format(age),
-                               'sex':record['GENDER'],
-                               'birthdate':record['dob'],
-                               'date_of_death':dod,
-                               'date':date,
-                               'ethnicity':ethnicity,
-                               'dhb':dhb,
-                               'drug':drug,
-                               'drug_group':drug_group,
-                               'dose_mg':dose_mg,
-                               'days_supply':days_supply
-                               }
-                    
-                    ## OLD: store in a dictionary
-                    #dispensings[nhi].append(summary)
-                    
-                    # New: Put in a DB:
-                    self.db.execute('INSERT INTO dispensings ' + 
-                                '(nhi, age, sex, birthdate, date_of_death, date, ethnicity, ' +
-                                'dhb, drug, drug_group, dose_mg, days_supply) ' +
-                                'VALUES (:nhi, :age, :sex, :birthdate, :date_of_death, :date, :ethnicity, ' +
-                                ':dhb, :drug, :drug_group, :dose_mg, :days_supply);', summary)
+                    batch['raw'].append(record)
+                    batch['record'].append(record_number)
+                    batch['nhi'].append(nhi)
+                    batch['drug_id'].append(drug_id)
+                    batch['drug'].append(drug)
+                    batch['drug_group'].append(drug_group)
+                    batch['date_dispensed'].append(date_dispensed)
+                    batch['date_day'].append(date_dispensed.toordinal())
                     
+                    if len(batch['raw']) == self.batch_size:
+                        process_batch(dataset_index, dataset, batch)
+                        since_checkpoint += len(batch['raw'])
+                        batch = defaultdict(list)
+                        
+                        # Periodically save progress, up to the end of this batch
+                        if since_checkpoint >= self.checkpoint_every:
+                            save_checkpoint(dataset_index, f.tell(), record_number)
+                            since_checkpoint = 0
+                
+                if batch:
+                    process_batch(dataset_index, dataset, batch)
+                
+                # Whole file loaded
+                save_checkpoint(dataset_index+1, 0, 0)
         
         self.dbconn.commit()
-                    
-        n_final_people = 0
-        n_final_records = 0
-        
-        n_excluded_records_single = 0
-        n_excluded_people_single = 0
-        
-        excluded_single_months = defaultdict(int)
+        fdod.close()
         
         print "All records read in. Now exporting by individual"
         
         #for person in sorted(dispensings.keys()):
         #    sorted_dispensings = sorted(dispensings[person], key=lambda k: k['age'])
         
-        persons = self.db.execute("SELECT DISTINCT nhi FROM dispensings ORDER BY nhi")
-        for person in persons.fetchall() :
-            sorted_dispensings = self.db.execute("SELECT * FROM dispensings WHERE nhi=? ORDER BY age",person).fetchall()
+        lookups = self.store.lookups()
+        
+        if self.sorter is not None:
+            # One pass through the merged runs
+            for cohort in cohorts:
+                cohort.open(record_fields, single_record_fields)
             
+            people = ((nhi, (dict(zip(DISPENSING_COLUMNS, dispensing)) for dispensing in dispensings))
+                      for nhi, dispensings in itertools.groupby(self.sorter.sorted(), operator.itemgetter(0)))
+            exported = [export_people(people, cohorts, lookups, missing_dose)]
             
+            for cohort in cohorts:
+                cohort.close()
             
-            # Count number of unique dates
-            dates = set()
-            for dispensing in sorted_dispensings:
-                dates.add(dispensing['date'])
+            # Nothing left to resume from
+            self.sorter.clear()
+            self.checkpoint.clear()
+        else:
+            # A process for each partition, then merge their files
+            arguments = [(part, fname, cohorts, record_fields, single_record_fields, lookups, missing_dose)
+                         for part, fname in enumerate(self.store.files)]
             
-            # Export data if dispensings on 2 or more dates
-            if len(dates) > 1:
-                n_final_people += 1
-                for dispensing in sorted_dispensings:
-                    n_final_records +=1
-                    dwp.writerow(dict_from_row(dispensing))
+            if self.processes == 1:
+                exported = map(export_partition, arguments)
             else:
-                for dispensing in sorted_dispensings:
-                    dispensing = dict_from_row(dispensing)
-                    if dispensing['date_of_death']:
-                        date_py = dateutil.parser.parse(dispensing['date'],dayfirst=True)
-                        dod_date_py = dateutil.parser.parse(dispensing['date_of_death'],dayfirst=True)
-                        dispensing['dod_delta']=(dod_date_py-date_py).days
-                    dwsd.writerow(dispensing)
-                n_excluded_records_single += len(sorted_dispensings)
-                n_excluded_people_single += 1
-                date_py = dateutil.parser.parse(dates.pop(),dayfirst=True)
-                excluded_single_months[date_py.strftime("%Y-%m")]+=1
-                
-        n_people = len(people)
-        
-        
-        empty_nhi=set(('','unknown'))
-        n_excluded_people_drug = len(excluded_drug - set(dispensings) - empty_nhi)
-        n_excluded_people_dod = len(excluded_dod - excluded_drug - set(dispensings) - empty_nhi)
-        n_excluded_people_age = len(excluded_age - excluded_drug - excluded_dod - set(dispensings) - empty_nhi)
-        
-        
-        print "{} records from {} people in raw data".format(n_records,n_people)
-        
-        print "{} records excluded and {} people removed due to only antipsychotic/dementia drug".format(n_excluded_records_drug,
-                                                                                                         n_excluded_people_drug)
-        
-        n_records_remain = n_records-n_excluded_records_drug
-        n_people_remain = n_people-n_excluded_people_drug
-        
-        print "{} records and {} people remain".format(n_records_remain,
-                                                       n_people_remain)
-        
-        print "{} records excluded due to missing NHI".format(n_excluded_records_nhi)
-        
-        print "{} records excluded and {} people removed due to date of death before dispensing date".format(n_excluded_records_dod,
-                                                                                                             n_excluded_people_dod)
-        
-        print "{} records excluded and {} people removed due to age < 20".format(n_excluded_records_age,
-                                                                                 n_excluded_people_age)
-        
-        print "{} records excluded and {} people removed due to only having a single date of dispensing".format(n_excluded_records_single,
-                                                                                                                n_excluded_people_single)
-        
-        n_records_remain_exlc = n_records_remain - n_excluded_records_nhi - n_excluded_records_dod - n_excluded_records_age - n_excluded_records_single
-        n_people_remain_excl = n_people_remain - n_excluded_people_dod - n_excluded_people_age - n_excluded_people_single
-        
-        print "{} records and {} people in final dataset (based upon exclusion counts)".format(n_records_remain_exlc,
-                                                                                         n_people_remain_excl)
+                pool = multiprocessing.Pool(self.processes)
+                exported = pool.map(export_partition, arguments)
+                pool.close()
+                pool.join()
+            
+            for cohort in cohorts:
+                merge_partitions(cohort.outfname, len(self.store.files))
+                merge_partitions(cohort.single_fname, len(self.store.files))
+            
+            # Nothing left to resume from
+            self.checkpoint.clear()
         
-        print "{} records and {} people in final dataset (based upon actual records exported)".format(n_final_records,n_final_people)
+        for numbers, single in exported:
+            for i, cohort in enumerate(cohorts):
+                cohort.n_final_people += numbers[i][0]
+                cohort.n_final_records += numbers[i][1]
+                for nhi in single[i]:
+                    audit.exclude_single(i, nhi)
         
+        self.dbconn.commit()
         
+        if self.deduplicate:
+            duplicates.write(duplicates_file)
         
-        print "Drugs excluded from final dataset:"
-        for drug in sorted(excluded_drug_names):
-            print drug
+        audit.write(exclusions_file, cohorts)
         
-        print "Missing doses for these drugs:"
-        print missing_dose
+        # Every record has a reason code for every cohort, so the totals are the same for each
+        n_people = audit.people(0)[0]
+        n_records = sum(audit.records(0))
+        total_records_by_year = audit.by(0, 'year')
+        total_by_drug = audit.by(0, 'drug_group')
         
-        print "Years and months of people with only a single prescription:"
-        print excluded_single_months
+        print "{} records from {} people in raw data".format(n_records,n_people)
         
-        for year in sorted(total_records_by_year.keys()):
-            print "{} - missing {:.1f}%".format(year,missing_nhi_by_year[year]*100.0/total_records_by_year[year])
+        for i, cohort in enumerate(cohorts):
+            
+            if len(cohorts) > 1:
+                print "\nCohort {} ({})".format(cohort.name, cohort.outfname)
+            
+            records = audit.records(i)
+            people = audit.people(i)[1]
+            
+            print "{} records excluded and {} people removed due to only antipsychotic/dementia drug".format(records[DRUG],
+                                                                                                             people[DRUG])
+            
+            n_records_remain = n_records-records[DRUG]
+            n_people_remain = n_people-people[DRUG]
+            
+            print "{} records and {} people remain".format(n_records_remain,
+                                                           n_people_remain)
+            
+            print "{} records excluded due to missing NHI".format(records[NHI])
+            
+            if self.deduplicate:
+                print "{} records excluded as duplicated in another extract".format(records[DUPLICATE])
+                for dataset, first_dataset in sorted(duplicates.pairs):
+                    print "    {} in {} and {}".format(duplicates.pairs[(dataset, first_dataset)], first_dataset, dataset)
+            
+            print "{} records excluded and {} people removed due to date of death before dispensing date".format(records[DOD],
+                                                                                                                 people[DOD])
+            
+            if cohort.min_age is not None:
+                print "{} records excluded and {} people removed due to age < {}".format(records[AGE],
+                                                                                         people[AGE],
+                                                                                         cohort.min_age)
             
-        for drug in sorted(total_by_drug.keys()):
-            print "{} - missing {:.1f}%".format(drug,missing_by_drug[drug]*100.0/total_by_drug[drug])
+            print "{} records excluded and {} people removed due to only having a single date of dispensing".format(records[SINGLE],
+                                                                                                                    people[SINGLE])
+            
+            n_records_remain_exlc = n_records_remain - records[NHI] - records[DUPLICATE] - records[DOD] - records[AGE] - records[SINGLE]
+            n_people_remain_excl = n_people_remain - people[DOD] - people[AGE] - people[SINGLE]
+            
+            print "{} records and {} people in final dataset (based upon exclusion counts)".format(n_records_remain_exlc,
+                                                                                             n_people_remain_excl)
+            
+            print "{} records and {} people in final dataset (based upon actual records exported)".format(cohort.n_final_records,
+                                                                                                        cohort.n_final_people)
+            
+            
+            
+            print "Drugs excluded from final dataset:"
+            for drug in sorted(audit.excluded_drugs(i)):
+                print drug
+            
+            print "Missing doses for these drugs:"
+            print missing_dose
+            
+            print "Years and months of people with only a single prescription:"
+            print audit.single_months(i)
+            
+            missing_nhi_by_year = audit.by(i, 'year', NHI)
+            for year in sorted(total_records_by_year.keys()):
+                print "{} - missing {:.1f}%".format(year,missing_nhi_by_year[year]*100.0/total_records_by_year[year])
+            
+            missing_by_drug = audit.by(i, 'drug_group', NHI)
+            for drug in sorted(total_by_drug.keys()):
+                print "{} - missing {:.1f}%".format(drug,missing_by_drug[drug]*100.0/total_by_drug[drug])
         
         #f_age_out = open("age_excluded.txt","w")
         #for item in excluded_age_dob:
@@ -514,85 +1283,103 @@ class PharmacData:
         
 
         
-if __name__ == '__main__':
+# Older datasets
+PD_DATASETS = (
+        {'filename':'phh0256/part1.csv',
+         'key':'phh0256/dim_form_pack_subsidy.csv',
+         'nhi':'PRIM_HCU',
+         'dod':'nhi_dod'
+         },
+        {'filename':'phh0436/part1.csv',
+         'key':'phh0436/dim_form_pack_subsidy.csv',
+         'nhi':'prim_hcu',
+         'dod':'nhi_dod'
+         },
+        {'filename':'phh0445/part1.csv',
+         'key':'phh0436/dim_form_pack_subsidy.csv',
+         'nhi':'prim_hcu',
+         'dod':'nhi_dod'
+         },
+        
+        )
+
+# PHH0563 yearly files
+NEW_DATASETS = (
+        {'filename':'phh0563/PHH0563_2005.csv',
+         'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
+         'nhi':'PRIM_HCU',
+         'dod':'DOD'
+         },
+        {'filename':'phh0563/PHH0563_2006.csv',
+         'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
+         'nhi':'PRIM_HCU',
+         'dod':'DOD'
+         },
+        {'filename':'phh0563/PHH0563_2007.csv',
+         'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
+         'nhi':'PRIM_HCU',
+         'dod':'DOD'
+         },
+        {'filename':'phh0563/PHH0563_2008.csv',
+         'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
+         'nhi':'PRIM_HCU',
+         'dod':'DOD'
+         },
+        {'filename':'phh0563/PHH0563_2009.csv',
+         'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
+         'nhi':'PRIM_HCU',
+         'dod':'DOD'
+         },
+        {'filename':'phh0563/PHH0563_2010.csv',
+         'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
+         'nhi':'PRIM_HCU',
+         'dod':'DOD'
+         },
+        {'filename':'phh0563/PHH0563_2011.csv',
+         'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
+         'nhi':'PRIM_HCU',
+         'dod':'DOD'
+         },
+        {'filename':'phh0563/PHH0563_2012.csv',
+         'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
+         'nhi':'PRIM_HCU',
+         'dod':'DOD'
+         },
+        {'filename':'phh0563/PHH0563_2013.csv',
+         'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
+         'nhi':'PRIM_HCU',
+         'dod':'DOD'
+         },
+        {'filename':'phh0563/PHH0563_2014.csv',
+         'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
+         'nhi':'PRIM_HCU',
+         'dod':'DOD'
+         },
+        )
 
-    pd_datasets = (
-            {'filename':'phh0256/part1.csv',
-             'key':'phh0256/dim_form_pack_subsidy.csv',
-             'nhi':'PRIM_HCU',
-             'dod':'nhi_dod'
-             },
-            {'filename':'phh0436/part1.csv',
-             'key':'phh0436/dim_form_pack_subsidy.csv',
-             'nhi':'prim_hcu',
-             'dod':'nhi_dod'
-             },
-            {'filename':'phh0445/part1.csv',
-             'key':'phh0436/dim_form_pack_subsidy.csv',
-             'nhi':'prim_hcu',
-             'dod':'nhi_dod'
-             },
-            
-            )
+if __name__ == '__main__':
 
-    #pharmac = PharmacData(pd_datasets,'output/included_records.csv')
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Process the raw prescription data')
+    parser.add_argument('--resume', action='store_true',
+                        help='Carry on loading from the last checkpoint of an unfinished run')
+    parser.add_argument('--staging', default='sqlite', choices=('sqlite','sort'),
+                        help='Group the included records by person in the database or by an external sort')
+    parser.add_argument('--sort-memory', type=int, default=256, metavar='MB',
+                        help='Memory for sorting before writing runs to disk (with --staging sort)')
+    sample.add_argument(parser)
+    args = parser.parse_args()
+    sample.from_arguments(args)
+    
+    #pharmac = PharmacData(PD_DATASETS,'output/included_records.csv')
     #pharmac.process_raw()
     
-    new_datasets = (
-                    {'filename':'phh0563/PHH0563_2005.csv',
-                     'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
-                     'nhi':'PRIM_HCU',
-                     'dod':'DOD'
-                     },
-                    {'filename':'phh0563/PHH0563_2006.csv',
-                     'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
-                     'nhi':'PRIM_HCU',
-                     'dod':'DOD'
-                     },
-                    {'filename':'phh0563/PHH0563_2007.csv',
-                     'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
-                     'nhi':'PRIM_HCU',
-                     'dod':'DOD'
-                     },
-                    {'filename':'phh0563/PHH0563_2008.csv',
-                     'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
-                     'nhi':'PRIM_HCU',
-                     'dod':'DOD'
-                     },
-                    {'filename':'phh0563/PHH0563_2009.csv',
-                     'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
-                     'nhi':'PRIM_HCU',
-                     'dod':'DOD'
-                     },
-                    {'filename':'phh0563/PHH0563_2010.csv',
-                     'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
-                     'nhi':'PRIM_HCU',
-                     'dod':'DOD'
-                     },
-                    {'filename':'phh0563/PHH0563_2011.csv',
-                     'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
-                     'nhi':'PRIM_HCU',
-                     'dod':'DOD'
-                     },
-                    {'filename':'phh0563/PHH0563_2012.csv',
-                     'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
-                     'nhi':'PRIM_HCU',
-                     'dod':'DOD'
-                     },
-                    {'filename':'phh0563/PHH0563_2013.csv',
-                     'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
-                     'nhi':'PRIM_HCU',
-                     'dod':'DOD'
-                     },
-                    {'filename':'phh0563/PHH0563_2014.csv',
-                     'key':'phh0563/DIM_FORM_PACK_SUBSIDY.csv',
-                     'nhi':'PRIM_HCU',
-                     'dod':'DOD'
-                     },
-                    )
-                    
-    pharmac = PharmacData(new_datasets,
+    pharmac = PharmacData(NEW_DATASETS,
                           'output/included_records_pd_protection.csv',
-                          exclude_under_20 = False
+                          exclude_under_20 = False,
+                          resume = args.resume,
+                          staging = args.staging,
+                          sort_memory = args.sort_memory*2**20
                           )
     pharmac.process_raw()    
\ No newline at end of file
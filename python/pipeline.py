@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+""" Run the preprocessing stages in dependency order
+
+Each stage declares the files it reads and writes. A stage is skipped when
+the content of its inputs, the code it runs and its outputs are unchanged
+since it last ran successfully. Stages that don't depend on each other are
+run at the same time in separate processes.
+
+    python pipeline.py                 # Run whatever has changed
+    python pipeline.py --from nmds     # Rerun nmds and everything after it
+    python pipeline.py --only process  # Rerun process only
+    python pipeline.py --sample 0.01   # Quick run with 1% of people
+"""
+from collections import OrderedDict
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import pharmacdata
+import sample
+
+CACHE_FILE = 'output/pipeline_cache.json'
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DIAGNOSES_FILES = ['input/diagnoses_alice_2016.csv',
+                   'input/diagnoses_tim_pp_2015.csv',
+                   'input/diagnoses_mspd_2015.csv',
+                   'input/diagnoses_clinic_2015.csv',
+                   'input/diagnoses_cdhb_2014.csv',
+                   'input/diagnoses_neurology_2015.csv',
+                   'input/diagnoses_all_sources.csv']
+
+INCLUDED_RECORDS = 'output/included_records_pd_protection.csv'
+
+def run_pharmacdata():
+    pharmac = pharmacdata.PharmacData(pharmacdata.NEW_DATASETS,
+                                      INCLUDED_RECORDS,
+                                      exclude_under_20 = False)
+    pharmac.process_raw()
+
+def run_nmds():
+    import nmds
+    nmds.MOHData(pharmac_filename=INCLUDED_RECORDS)
+
+def run_rates():
+    import rates
+    rates.main()
+
+def run_process():
+    import process
+    process.process_prescriptions_csv(INCLUDED_RECORDS,
+                                      "output/continuity.csv",
+                                      "output/classification.csv",
+                                      "input/diagnoses_all_sources.csv",
+                                      "output/moh_diagnoses.csv",
+                                      "output/providers.csv",
+                                      "output/classification_counts.csv",
+                                      "output/persons.csv",
+                                      "output/person_years.csv",
+                                      incremental = True)
+
+
+class Stage:
+    """ A step of the pipeline with the files it reads and writes """
+
+    def __init__(self, name, run, inputs, outputs, code):
+        self.name = name
+        self.run = run
+        self.inputs = inputs
+        self.outputs = outputs
+        self.code = code
+
+    def __repr__(self):
+        return self.name
+
+def dataset_files(datasets):
+    files = []
+    for dataset in datasets:
+        for fname in (dataset['filename'], dataset['key']):
+            if "raw/"+fname not in files:
+                files.append("raw/"+fname)
+    return files
+
+STAGES = OrderedDict((stage.name, stage) for stage in (
+    Stage('pharmacdata', run_pharmacdata,
+          inputs = dataset_files(pharmacdata.NEW_DATASETS),
+          outputs = [INCLUDED_RECORDS,
+                     'output/single_dispensing.csv',
+                     'output/duplicate_dispensings.csv',
+                     'output/disepensing_after_dod.csv',
+                     'output/exclusions.csv'],
+          code = ['pharmacdata.py','extsort.py','sample.py']),
+    Stage('nmds', run_nmds,
+          inputs = ['raw/mos3358all/mos3358.csv',
+                    'raw/mos3464/mos3464.csv',
+                    'raw/pus9058all/pus9058.csv',
+                    INCLUDED_RECORDS],
+          outputs = ['output/moh_diagnoses.csv',
+                     'output/moh_missing_in_pharms.csv',
+                     'output/moh_conditions.csv',
+                     'output/moh_events.csv',
+                     'output/admission_diagnoses.csv'],
+          code = ['nmds.py','conditions.py','pharmacdata.py','extsort.py','sample.py']),
+    Stage('process', run_process,
+          inputs = DIAGNOSES_FILES + [INCLUDED_RECORDS, 'output/moh_diagnoses.csv',
+                                      'input/medical_council.csv'],
+          outputs = ['output/continuity.csv',
+                     'output/classification.csv',
+                     'output/providers.csv',
+                     'output/incidence.csv',
+                     'output/classification_counts.csv',
+                     'output/persons.csv',
+                     'output/person_years.csv'],
+          code = ['process.py','diagnoses.py','counts.py','sample.py']),
+    Stage('rates', run_rates,
+          inputs = ['output/classification_counts.csv',
+                    'input/pop-by-year-sex-age5.csv',
+                    'input/pop-by-ethnicity-age5-sex-2013.csv',
+                    'input/dhb-age-sex-2013.csv',
+                    'input/dhb-ethnicity-age-sex-2013-processed.csv',
+                    'input/standard-pop-age.csv',
+                    'input/standard-pop-age-sex.csv',
+                    'input/pop-by-year-nhi-percent.csv'],
+          outputs = ['output/rates.csv'],
+          code = ['rates.py']),
+    ))
+
+
+def upstream(stage, stages=STAGES):
+    """ Names of the stages that write any of the inputs of a stage """
+    return [other.name for other in stages.values()
+            if other is not stage and set(other.outputs) & set(stage.inputs)]
+
+def downstream(name, stages=STAGES):
+    """ Names of a stage and all stages that depend on it, directly or not """
+
+    names = [name]
+    for other in stages.values():
+        if any(parent in names for parent in upstream(other, stages)) and other.name not in names:
+            names.append(other.name)
+    return names
+
+
+class FileHashes:
+    """ Content hashes of files, only rehashed when size or modification time changes """
+
+    def __init__(self, known=None):
+        self.known = known or dict()
+
+    def hash(self, fname):
+
+        if not os.path.exists(fname):
+            return 'missing'
+
+        stat = os.stat(fname)
+        key = [stat.st_size, stat.st_mtime]
+
+        try:
+            if self.known[fname]['stat'] == key:
+                return self.known[fname]['hash']
+        except KeyError:
+            pass
+
+        sha = hashlib.sha1()
+        with open(fname, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+
+        self.known[fname] = {'stat':key, 'hash':sha.hexdigest()}
+        return self.known[fname]['hash']
+
+
+def stage_digest(stage, hashes):
+    """ Digest of everything a stage depends on: its code (and this file's) and input contents """
+
+    sha = hashlib.sha1()
+    sha.update("sample:{}\n".format(sample.fraction))
+    for fname in ['pipeline.py'] + stage.code:
+        sha.update("code:{}:{}\n".format(fname, hashes.hash(os.path.join(CODE_DIR, fname))))
+    for fname in stage.inputs:
+        sha.update("input:{}:{}\n".format(fname, hashes.hash(fname)))
+    return sha.hexdigest()
+
+def is_current(stage, cache, hashes):
+    """ True if the stage ran with the same digest and its outputs are untouched since """
+
+    try:
+        previous = cache['stages'][stage.name]
+    except KeyError:
+        return False
+
+    if previous['digest'] != stage_digest(stage, hashes):
+        return False
+
+    for fname in stage.outputs:
+        if previous['outputs'].get(fname) != hashes.hash(fname):
+            return False
+
+    return True
+
+def load_cache(fname=CACHE_FILE):
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {'stages':{}, 'files':{}}
+
+def save_cache(cache, fname=CACHE_FILE):
+    with open(fname+'.tmp', "w") as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.rename(fname+'.tmp', fname)
+
+
+def run_stage(stage):
+    """ Entry point of the process running a stage """
+
+    stdout, stderr = sys.stdout, sys.stderr
+    with open('output/pipeline_{}.log'.format(stage.name), "w") as log:
+        sys.stdout = sys.stderr = log
+        try:
+            stage.run()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+
+def run_pipeline(selected, forced=(), jobs=None, dry_run=False, stages=STAGES):
+    """ Run the selected stages in dependency order
+
+    Stages in forced are run even if they are current. Stages not selected
+    are assumed to be up to date.
+    """
+
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    cache = load_cache()
+    hashes = FileHashes(cache['files'])
+
+    pending = [name for name in stages if name in selected]
+    running = dict()
+    failed = []
+    finished = [name for name in stages if name not in selected]
+
+    while pending or running:
+
+        # Start any stage whose upstream stages have all finished
+        for name in list(pending):
+            stage = stages[name]
+            waiting_on = [parent for parent in upstream(stage, stages) if parent not in finished]
+
+            if any(parent in failed for parent in waiting_on):
+                print "{}: skipped as an upstream stage failed".format(name)
+                pending.remove(name)
+                failed.append(name)
+                continue
+
+            if waiting_on or len(running) >= jobs:
+                continue
+
+            pending.remove(name)
+
+            if name not in forced and is_current(stage, cache, hashes):
+                print "{}: up to date".format(name)
+                finished.append(name)
+                continue
+
+            if dry_run:
+                print "{}: would run".format(name)
+                finished.append(name)
+                continue
+
+            print "{}: running (log in output/pipeline_{}.log)".format(name, name)
+            digest = stage_digest(stage, hashes)
+            process = multiprocessing.Process(target=run_stage, args=(stage,), name=name)
+            process.start()
+            running[name] = (process, digest, time.time())
+
+        # Wait for running stages
+        for name in list(running):
+            process, digest, start = running[name]
+            if process.is_alive():
+                continue
+
+            del running[name]
+            if process.exitcode == 0:
+                print "{}: finished in {:.0f}s".format(name, time.time()-start)
+                cache['stages'][name] = {'digest':digest,
+                                         'outputs':dict((fname, hashes.hash(fname))
+                                                        for fname in stages[name].outputs)}
+                cache['files'] = hashes.known
+                save_cache(cache)
+                finished.append(name)
+            else:
+                print "{}: failed with exit code {}".format(name, process.exitcode)
+                failed.append(name)
+
+        if running:
+            time.sleep(0.5)
+
+    return failed
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Run the preprocessing stages')
+    parser.add_argument('--only', nargs='+', choices=STAGES.keys(), metavar='STAGE',
+                        help='Only run these stages (always rerun)')
+    parser.add_argument('--from', dest='start', choices=STAGES.keys(), metavar='STAGE',
+                        help='Rerun this stage and all that depend upon it')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Maximum number of stages to run at the same time')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Show what would run without running it')
+    sample.add_argument(parser)
+    args = parser.parse_args()
+    sample.from_arguments(args)
+
+    if args.only:
+        selected = forced = args.only
+    elif args.start:
+        selected = STAGES.keys()
+        forced = downstream(args.start)
+    else:
+        selected = STAGES.keys()
+        forced = []
+
+    failed = run_pipeline(selected, forced, args.jobs, args.dry_run)
+
+    if failed:
+        print "Failed: {}".format(", ".join(failed))
+        sys.exit(1)
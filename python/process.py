@@ -4,22 +4,30 @@ import dateutil.parser
 import datetime
 import operator
 import sys,traceback
+import cPickle
 import csv
+import hashlib
+import itertools
 import numpy
+import os
+import sqlite3
 
 import diagnoses
+import counts
+import sample
 #from __builtin__ import None
 
 
 class Dispensing:
     """Details of a dispensing"""
     
-    def __init__(self, date, days, dose = None):
-        """(self, string, int, float) -> None"""
+    def __init__(self, date, days, dose = None, provider = None):
+        """(self, string, int, float, string) -> None"""
         
         self.date = dateutil.parser.parse(date,dayfirst=True)
         self.days = days
         self.dose = dose
+        self.provider = provider
         self.last_date = self.date + datetime.timedelta(days=self.days)
         
     def __lt__(self, other):
@@ -29,13 +37,65 @@ class Dispensing:
     def __repr__(self):
         return "{}:{}".format(self.date,self.days)
 
+# Medical Council register of prescribers, with each one's scope of practice
+MEDICAL_COUNCIL = 'input/medical_council.csv'
+REGISTRATION_FIELD = 'registration_number'
+SCOPE_FIELD = 'scope'
+
+# Scopes of general practitioners, any other scope is a specialist
+GP_SCOPES = ('general practice', 'general scope')
+
+class Providers:
+    """ Kind of each prescriber (GP or specialist), from the medical register
+    
+    The register is read once into a dictionary by registration number, so
+    looking up the provider of a dispensing is a single dictionary lookup.
+    Providers not in the register are 'Unknown'.
+    """
+    
+    kinds = ('GP','Specialist','Unknown')
+    
+    def __init__(self, fname=MEDICAL_COUNCIL):
+        self.kind_of = dict()
+        
+        sha = hashlib.sha1()
+        try:
+            with open(fname, "r") as f:
+                for row in csv.DictReader(f):
+                    number = row[REGISTRATION_FIELD].strip()
+                    scope = row[SCOPE_FIELD].strip()
+                    sha.update('{}\x1f{}\n'.format(number, scope))
+                    if scope.lower() in GP_SCOPES:
+                        self.kind_of[number] = 'GP'
+                    else:
+                        self.kind_of[number] = 'Specialist'
+        except IOError:
+            traceback.print_exc(file=sys.stdout)
+            print("Unable to open {0}, all providers will be unknown".format(fname))
+        
+        # Results depending on the register are out of date when it changes
+        self.version = sha.hexdigest()
+        self.unknown = set()
+    
+    def kind(self, provider):
+        return self.kind_of.get(provider, 'Unknown')
+    
+    def add_unknown(self, providers):
+        """ Count providers (of any person) not in the register """
+        self.unknown.update(providers)
+    
+    def number_unknown(self):
+        """ Number of distinct providers not in the register """
+        return len(self.unknown)
+
 class Dispensings:
     """Methods to add and summarise dispensings that a particular individual has had"""
     
     def __init__(self, nhi, age=None, sex = None, birthdate = None,
                  continuityFile=None, classificationFile=None,
                  diagnosis="Empty",local_diagnosis="Empty",moh_diagnosis="Empty",
-                 medical_registrar=None):
+                 medical_registrar=None, classificationCounts=None,
+                 person_id=None, personsFile=None, personYearsFile=None):
         
         self.nhi = nhi
         self.age = age
@@ -49,6 +109,10 @@ class Dispensings:
         self.durations = defaultdict(list)
         self.fOutContinuity = continuityFile
         self.fOutClassification = classificationFile
+        self.classificationCounts = classificationCounts
+        self.person_id = person_id
+        self.fOutPersons = personsFile
+        self.fOutPersonYears = personYearsFile
         self.diagnosis = diagnosis
         self.local_diagnosis = local_diagnosis
         self.moh_diagnosis = moh_diagnosis
@@ -86,8 +150,38 @@ class Dispensings:
                 ethnicity = item
         return ethnicity    
     
-    def add_dispensing(self,drug,date,days,dose=None):
-        self.dispensings[drug].append(Dispensing(date,days,dose))
+    def add_dispensing(self,drug,date,days,dose=None,provider=None):
+        self.dispensings[drug].append(Dispensing(date,days,dose,provider))
+    
+    def dispensings_by_provider(self):
+        """ Number of dispensings prescribed by each provider """
+        
+        by_provider = defaultdict(int)
+        for drug in self.dispensings:
+            for dispensing in self.dispensings[drug]:
+                if dispensing.provider not in (None,''):
+                    by_provider[dispensing.provider] += 1
+        return by_provider
+    
+    def total_number_providers(self):
+        return len(self.dispensings_by_provider())
+    
+    def unknown_providers(self):
+        """ Providers of this person's dispensings not in the medical register """
+        return sorted(provider for provider in self.dispensings_by_provider()
+                      if self.medical_registar.kind(provider) == 'Unknown')
+    
+    def provider_shares(self):
+        """ Share of dispensings prescribed by GPs, specialists and unknown providers """
+        
+        by_kind = defaultdict(int)
+        for provider, n in self.dispensings_by_provider().iteritems():
+            by_kind[self.medical_registar.kind(provider)] += n
+        
+        total = sum(by_kind.values())
+        if total == 0:
+            return dict((kind, 'NA') for kind in Providers.kinds)
+        return dict((kind, "{:.3f}".format(by_kind[kind]/float(total))) for kind in Providers.kinds)
     
     def years_receieved_drugs(self):
         years = set()
@@ -237,6 +331,28 @@ class Dispensings:
             
             self.final_classification = classification
             
+            # Fields that are the same for every year
+            person = {'nhi': self.nhi,
+                      'sex': self.sex,
+                      'ethnicity': self.primary_ethnicity(),
+                      'dhb': self.primary_dhb(),
+                      'classification': classification,
+                      'subclassification': "{}-{}".format(classification,subclassification),
+                      'years_of_data': nyears,
+                      'year_first_seen':first_year,
+                      'age_first_seen':"{:.1f}".format(self.age_at_year(first_year)),
+                      'year_last_seen':last_year,
+                      'diagnosis':self.diagnosis,
+                      'local_diagnosis':self.local_diagnosis,
+                      'moh_diagnosis':self.moh_diagnosis,
+                      'dose':dose,
+                      'ldopa_on_days':self.ldopa_days,
+                      'ldopa_first_to_last_days':self.ldopa_period,
+                      'days_unmedicated_before_death':self.days_unmedicated_before_death()}
+            
+            if self.fOutPersons is not None:
+                self.fOutPersons.writerow(dict(person, person_id=self.person_id))
+            
             for year in sorted_years:
                 
                 year_in_data += 1
@@ -259,31 +375,22 @@ class Dispensings:
                     else:
                         future_status = 'MISSING_BUT_RETURN'
                 
-                data={'nhi': self.nhi,
-                     'age': "{:.1f}".format(self.age_at_year(year)),
-                     'sex': self.sex,
-                     'ethnicity': self.primary_ethnicity(),
-                     'dhb': self.primary_dhb(),
-                     'year': year,
-                     'classification': classification,
-                     'subclassification': "{}-{}".format(classification,subclassification),
-                     'years_of_data': nyears,
-                     'year_in_data': year_in_data,
-                     'year_first_seen':first_year,
-                     'age_first_seen':"{:.1f}".format(self.age_at_year(first_year)),
-                     'year_last_seen':last_year,
-                     'diagnosis':self.diagnosis,
-                     'local_diagnosis':self.local_diagnosis,
-                     'moh_diagnosis':self.moh_diagnosis,
-                     'dose':dose,
-                     'ldopa_on_days':self.ldopa_days,
-                     'ldopa_first_to_last_days':self.ldopa_period,
-                     'days_unmedicated_before_death':self.days_unmedicated_before_death(),
-                     'future_status':future_status
-                }
-
+                year_data = {'age': "{:.1f}".format(self.age_at_year(year)),
+                             'year': year,
+                             'year_in_data': year_in_data,
+                             'future_status':future_status}
+                
+                if self.fOutPersonYears is not None:
+                    self.fOutPersonYears.writerow(dict(year_data, person_id=self.person_id))
                 
-                self.fOutClassification.writerow(data)
+                data = dict(person)
+                data.update(year_data)
+                
+                if self.fOutClassification is not None:
+                    self.fOutClassification.writerow(data)
+                
+                if self.classificationCounts is not None:
+                    self.classificationCounts.add(data)
                 
     def classify_worker(self,drugs_received,year=None):
         pd_only_drugs = ['Apomorphine','Pergolide','Tolcapone','Entacapone']
@@ -442,7 +549,178 @@ class Dispensings:
         print "Not classified: ", drugs_received
         return "Not classified", "None", "NA"
         
-def process_prescriptions_csv(inFile,outContinuity,outClassification,inDiagnoses,inMohDiagnoses):
+RESULTS_DB = 'output/process.db'
+
+class Rows:
+    """ Rows written for one person, kept to be written out (and stored) later """
+    
+    def __init__(self):
+        self.rows = []
+    
+    def writerow(self, row):
+        self.rows.append(row)
+
+def code_version():
+    """ Digest of this file, results stored by a different version are discarded """
+    
+    with open(os.path.splitext(os.path.abspath(__file__))[0] + '.py', "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+class PersonResults:
+    """ Each person's rows from when they were last classified, by NHI
+    
+    Stored with a digest of everything the rows depend on (the person's
+    dispensings and diagnoses), so they're only reused while that is
+    unchanged. Everything is discarded when the version (of this file and
+    the medical register) changes. People not seen in a run are removed at
+    the end of it.
+    """
+    
+    def __init__(self, fname=RESULTS_DB, version=None):
+        self.conn = sqlite3.connect(fname)
+        self.db = self.conn.cursor()
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key text PRIMARY KEY, value text)')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS people
+                           (nhi text PRIMARY KEY, digest text, run integer, results blob) WITHOUT ROWID''')
+        
+        if version is None:
+            version = code_version()
+        row = self.db.execute("SELECT value FROM meta WHERE key='version'").fetchone()
+        if row is None or row[0] != version:
+            self.db.execute('DELETE FROM people')
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version',?)", (version,))
+        
+        self.run = (self.db.execute('SELECT max(run) FROM people').fetchone()[0] or 0) + 1
+        self.reused = 0
+        self.classified = 0
+    
+    def get(self, nhi, digest):
+        """ Stored rows of a person, or None if they have changed or are new """
+        
+        row = self.db.execute('SELECT digest, results FROM people WHERE nhi=?', (nhi,)).fetchone()
+        if row is None or row[0] != digest:
+            return None
+        
+        self.db.execute('UPDATE people SET run=? WHERE nhi=?', (self.run, nhi))
+        self.reused += 1
+        return cPickle.loads(str(row[1]))
+    
+    def put(self, nhi, digest, results):
+        self.db.execute('INSERT OR REPLACE INTO people VALUES (?,?,?,?)',
+                        (nhi, digest, self.run,
+                         sqlite3.Binary(cPickle.dumps(results, cPickle.HIGHEST_PROTOCOL))))
+        self.classified += 1
+    
+    def close(self):
+        removed = self.db.execute('DELETE FROM people WHERE run<>?', (self.run,)).rowcount
+        self.conn.commit()
+        self.conn.close()
+        print "Reclassified {} people, {} unchanged, {} no longer present".format(self.classified,
+                                                                                 self.reused,
+                                                                                 removed)
+
+def person_digest(fieldnames, records, person_diagnoses):
+    """ Digest of a person's dispensing records and diagnoses """
+    
+    sha = hashlib.sha1()
+    for record in records:
+        sha.update('\x1f'.join(record[field] for field in fieldnames) + '\n')
+    sha.update('\x1f'.join(person_diagnoses))
+    return sha.hexdigest()
+
+def classify_person(nhi, records, person_diagnoses, providers):
+    """ Rows of each output for a person, from their dispensing records
+    
+    The rows are returned rather than written, so they can be stored and
+    written again while the person is unchanged.
+    """
+    
+    diagnosis, local_diagnosis, moh_diagnosis = person_diagnoses
+    
+    rows = dict((output, Rows()) for output in ('continuity','classification',
+                                                'persons','person_years'))
+    dispensings = Dispensings(nhi,
+                              float(records[0]['age']),
+                              records[0]['sex'],
+                              records[0]['birthdate'],
+                              rows['continuity'],
+                              rows['classification'],
+                              diagnosis,
+                              local_diagnosis,
+                              moh_diagnosis,
+                              providers,
+                              None,
+                              None,
+                              rows['persons'],
+                              rows['person_years'])
+    
+    for record in records:
+        
+        dispensings.ethnicity[record['ethnicity']] += 1
+        dispensings.dhb[record['dhb']] += 1
+        
+        if record['date_of_death'] != 'NA':
+            dispensings.date_of_death = record['date_of_death']
+        
+        if 'NA' in record['dose_mg']:
+            dose = None
+        else:
+            dose = float(record['dose_mg'])
+            
+        if record['days_supply'] == 'NA':
+            days = 0
+        else:
+            days = int(record['days_supply'])
+            
+        ## Add dispensing
+        dispensings.add_dispensing(drug = record['drug'].replace('"',''),
+                                   date = record['date'],
+                                   days = days,
+                                   dose = dose,
+                                   provider = record.get('provider_id'))
+    
+    ## Process data collected
+    dispensings.process_dispensings()
+    dispensings.classify(by_year=True)
+    
+    results = dict((output, rows[output].rows) for output in rows)
+    shares = dispensings.provider_shares()
+    results['provider'] = {'nhi':nhi,
+                           'dhb':dispensings.primary_dhb(),
+                           'nproviders':dispensings.total_number_providers(),
+                           'nunknown':len(dispensings.unknown_providers()),
+                           'gp_share':shares['GP'],
+                           'specialist_share':shares['Specialist'],
+                           'unknown_share':shares['Unknown']}
+    results['unknown_providers'] = dispensings.unknown_providers()
+    results['incidence'] = {'nhi':nhi,
+                            'age':dispensings.age,
+                            'year':dispensings.first_year,
+                            'month':dispensings.first_month,
+                            'classification':dispensings.final_classification}
+    return results
+
+def process_prescriptions_csv(inFile,outContinuity,outClassification,inDiagnoses,inMohDiagnoses,
+                              outProviders="output/providers.csv",
+                              outCounts="output/classification_counts.csv",
+                              outPersons=None, outPersonYears=None,
+                              incremental=False, results_filename=RESULTS_DB,
+                              inMedicalCouncil=MEDICAL_COUNCIL):
+    """ Classify everyone in the dispensings file
+    
+    The classification by year repeats the fields for each person on every year.
+    If outPersons and outPersonYears are given, the same information is also
+    written as one row per person and a slim row per person-year, linked by an
+    integer person_id. outClassification can be None to only write these.
+    
+    If incremental, each person's rows are stored in results_filename and only
+    people whose dispensings or diagnoses have changed since the last run are
+    classified again, everyone else's rows are written out from the store.
+    
+    Prescribers are looked up in the medical register inMedicalCouncil, for
+    each person's number of providers and shares of dispensings prescribed by
+    GPs, specialists and providers not in the register.
+    """
     
     #Continuity of drugs
     fOutContinuity = open(outContinuity, "w")
@@ -453,20 +731,45 @@ def process_prescriptions_csv(inFile,outContinuity,outClassification,inDiagnoses
     dwcont = csv.DictWriter(fOutContinuity,delimiter=',',restval='NA',fieldnames=OrderedDict(fields))
     dwcont.writeheader()
     
-    fOutClassification = open(outClassification, "w")
-    fields = [('nhi',1), ('age',2), ('sex',3), ('ethnicity',4), ('dhb',5), 
-              ('year',6), ('classification',7), ('subclassification',8),
-              ('years_of_data',9), ('year_in_data',10), ('year_first_seen',11),
-              ('age_first_seen',12), ('year_last_seen',13), ('diagnosis',14), 
-              ('local_diagnosis',14),('moh_diagnosis',14),('dose',15),
-              ('ldopa_on_days',16), ('ldopa_first_to_last_days',17), 
-              ('days_unmedicated_before_death',18),('future_status',19)]
-    dwclass = csv.DictWriter(fOutClassification,delimiter=',',restval='NA',fieldnames=OrderedDict(fields))
-    dwclass.writeheader()
+    if outClassification is not None:
+        fOutClassification = open(outClassification, "w")
+        fields = [('nhi',1), ('age',2), ('sex',3), ('ethnicity',4), ('dhb',5), 
+                  ('year',6), ('classification',7), ('subclassification',8),
+                  ('years_of_data',9), ('year_in_data',10), ('year_first_seen',11),
+                  ('age_first_seen',12), ('year_last_seen',13), ('diagnosis',14), 
+                  ('local_diagnosis',14),('moh_diagnosis',14),('dose',15),
+                  ('ldopa_on_days',16), ('ldopa_first_to_last_days',17), 
+                  ('days_unmedicated_before_death',18),('future_status',19)]
+        dwclass = csv.DictWriter(fOutClassification,delimiter=',',restval='NA',fieldnames=OrderedDict(fields))
+        dwclass.writeheader()
+    else:
+        dwclass = None
+    
+    # Normalised classification: people and person-years
+    if outPersons is not None:
+        fOutPersons = open(outPersons, "w")
+        fields = [('person_id',1), ('nhi',2), ('sex',3), ('ethnicity',4), ('dhb',5), 
+                  ('classification',6), ('subclassification',7),
+                  ('years_of_data',8), ('year_first_seen',9),
+                  ('age_first_seen',10), ('year_last_seen',11), ('diagnosis',12), 
+                  ('local_diagnosis',13),('moh_diagnosis',14),('dose',15),
+                  ('ldopa_on_days',16), ('ldopa_first_to_last_days',17), 
+                  ('days_unmedicated_before_death',18)]
+        dwpersons = csv.DictWriter(fOutPersons,delimiter=',',restval='NA',fieldnames=OrderedDict(fields))
+        dwpersons.writeheader()
+        
+        fOutPersonYears = open(outPersonYears, "w")
+        fields = [('person_id',1), ('year',2), ('age',3), ('year_in_data',4), ('future_status',5)]
+        dwpersonyears = csv.DictWriter(fOutPersonYears,delimiter=',',restval='NA',fieldnames=OrderedDict(fields))
+        dwpersonyears.writeheader()
+    else:
+        dwpersons = None
+        dwpersonyears = None
     
     # Summary of providers
     fOutProviders = open(outProviders, "w")
-    fields =[('nhi',None),('nproviders',None),('dhb',None)]
+    fields =[('nhi',None),('nproviders',None),('dhb',None),('nunknown',None),
+             ('gp_share',None),('specialist_share',None),('unknown_share',None)]
     dwp = csv.DictWriter(fOutProviders, delimiter=',',restval='NA',fieldnames=OrderedDict(fields))
     dwp.writeheader()
     
@@ -481,102 +784,109 @@ def process_prescriptions_csv(inFile,outContinuity,outClassification,inDiagnoses
     dwi = csv.DictWriter(fOutIncidence, delimiter=',',restval='NA',fieldnames=ordered_fieldnames)
     dwi.writeheader()
         
+    # Prevalence and incidence counts by year, classification, ethnicity, sex, DHB and age
+    classification_counts = counts.ClassificationCounts()
+    
     all_diagnoses = diagnoses.Diagnoses(inDiagnoses,inMohDiagnoses)
     providers = Providers(inMedicalCouncil)
     
     
+    if incremental:
+        stored = PersonResults(results_filename, code_version() + providers.version)
+    else:
+        stored = None
+    
+    def write_person(results, person_id):
+        
+        for row in results['continuity']:
+            dwcont.writerow(row)
+        
+        for row in results['classification']:
+            if dwclass is not None:
+                dwclass.writerow(row)
+            classification_counts.add(row)
+        
+        if dwpersons is not None:
+            for row in results['persons']:
+                dwpersons.writerow(dict(row, person_id=person_id))
+            for row in results['person_years']:
+                dwpersonyears.writerow(dict(row, person_id=person_id))
+        
+        dwp.writerow(results['provider'])
+        providers.add_unknown(results['unknown_providers'])
+        
+        dwi.writerow(results['incidence'])
+    
+    def process_person(nhi, person_records, person_id):
+        """ Classify a person (or reuse their stored rows) and write them out """
+        
+        # Use CDHB/Clinic diagnoses as default, if don't have use MoH diagnoses
+        person_diagnoses = (all_diagnoses.getDiagnosis(nhi),
+                            all_diagnoses.getLocalDiagnosis(nhi),
+                            all_diagnoses.getMohDiagnosis(nhi))
+        
+        results = None
+        if stored is not None:
+            digest = person_digest(records.fieldnames, person_records, person_diagnoses)
+            results = stored.get(nhi, digest)
+        
+        if results is None:
+            results = classify_person(nhi, person_records, person_diagnoses, providers)
+            if stored is not None:
+                stored.put(nhi, digest, results)
+        
+        write_person(results, person_id)
+    
     with open(inFile, "r") as f:        
         records = csv.DictReader(f)
+        people = itertools.groupby((record for record in records if sample.keep(record['nhi'])),
+                                   operator.itemgetter('nhi'))
         
-        previous_nhi=None
-        for record in records:
-                
-            nhi = record['nhi']
-            
-            ## If this nhi is new we need to process dispsensing for previous nhi
-            ## Then create an empty dispensings object for new nhi
-            ## Corner case in that for first line the nhi will be different but 
-            ## their will be no previous dispensings to process
-            if previous_nhi != nhi:
-                
-                if previous_nhi != None:
-                    ## Process data collected
-                    dispensings.process_dispensings()
-                    dispensings.classify(by_year=True)
-                    #everyone.append(dispensings)
-                    #print "DHB {}, Providers {}, Ethnicity {}".format(dispensings.dhb,dispensings.provider,dispensings.ethnicity)
-                    dwp.writerow({'nhi':nhi,
-                                  'dhb':dispensings.primary_dhb(),
-                                  #'nproviders':dispensings.total_number_providers()
-                                  })
-                    
-                    dwi.writerow({'nhi':nhi,
-                                  'age':dispensings.age,
-                                  'year':dispensings.first_year,
-                                  'month':dispensings.first_month,
-                                  'classification':dispensings.final_classification})
-                    #dispensings.check_for_unknown_providers()
-                    
-                ## Setup for new records
-                age = float(record['age'])
-                sex = record['sex']
-                
-                # Use CDHB/Clinic diagnoses as default, if don't have use MoH diagnoses
-                diagnosis = all_diagnoses.getDiagnosis(nhi)
-                local_diagnosis = all_diagnoses.getLocalDiagnosis(nhi)
-                moh_diagnosis = all_diagnoses.getMohDiagnosis(nhi)
-                
-                dispensings = Dispensings(nhi,
-                                          age,
-                                          sex,
-                                          record['birthdate'],
-                                          dwcont,
-                                          dwclass,
-                                          diagnosis,
-                                          local_diagnosis,
-                                          moh_diagnosis,
-                                          providers)
-            
-            previous_nhi=nhi
-            
-            dispensings.ethnicity[record['ethnicity']] += 1
-            dispensings.dhb[record['dhb']] += 1
-            
-            if record['date_of_death'] != 'NA':
-                dispensings.date_of_death = record['date_of_death']
-            
-            if 'NA' in record['dose_mg']:
-                dose = None
-            else:
-                dose = float(record['dose_mg'])
-                
-            if record['days_supply'] == 'NA':
-                days = 0
-            else:
-                days = int(record['days_supply'])
-                
-            ## Add dispensing
-            dispensings.add_dispensing(drug = record['drug'].replace('"',''),
-                                       date = record['date'],
-                                       days = days,
-                                       dose = dose)
+        # Each person's records are together, so they're classified as soon as all are read
+        person_id=0
+        for nhi, person_records in people:
+            person_id += 1
+            process_person(nhi, list(person_records), person_id)
         
         fOutContinuity.close()
-        fOutClassification.close()
+        if outClassification is not None:
+            fOutClassification.close()
+        if outPersons is not None:
+            fOutPersons.close()
+            fOutPersonYears.close()
+        
+        classification_counts.write(outCounts)
+        
+        if stored is not None:
+            stored.close()
         
         print "Unknown IDs: {}".format(providers.number_unknown())
 
 
 
 if __name__ == '__main__':
-    inFile = "output/included_records.csv"
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Classify people from their dispensings')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only classify people whose dispensings or diagnoses changed since the last '
+                             'incremental run, reusing everyone else\'s results from {}'.format(RESULTS_DB))
+    sample.add_argument(parser)
+    args = parser.parse_args()
+    sample.from_arguments(args)
+    
+    inFile = "output/included_records_pd_protection.csv"
     inDiagnoses = "input/diagnoses_all_sources.csv" 
     inMohDiagnoses = "output/moh_diagnoses.csv" 
     
     outContinuity = "output/continuity.csv"
     outClassification = "output/classification.csv"
     outProviders = "output/providers.csv"
+    outCounts = "output/classification_counts.csv"
+    outPersons = "output/persons.csv"
+    outPersonYears = "output/person_years.csv"
 
     
     process_prescriptions_csv(inFile,outContinuity,outClassification,
-                                inDiagnoses,inMohDiagnoses)
+                                inDiagnoses,inMohDiagnoses,outProviders,outCounts,
+                                outPersons,outPersonYears,args.incremental)
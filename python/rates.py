@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+""" Crude and age-standardised prevalence and incidence rates
+
+Counts come from the pre-aggregated counts written by process.py
+(output/classification_counts.csv) and populations from the census and
+ERP tables in input/. Every table is loaded once into a numpy array with
+labelled axes (year, sex, ethnicity, dhb, age), so rates for any
+stratification are array reductions.
+"""
+from collections import OrderedDict
+import csv
+import numpy
+
+# 5 year age groups used for standardised prevalence and incidence (agecut5_85)
+AGES_85 = ['20','25','30','35','40','45','50','55','60','65','70','75','80','85+']
+
+# Correction for percent of population that isn't medicated
+UNMEDICATED_CORRECTION = 1.05
+
+# Correct for unknown ethnicity in MoH data. Assume MAR by ethnicity
+UNKNOWN_ETHNICITY_CORRECTION = 1.025
+
+TO_PER_100000 = 100000
+
+
+def read_number(value):
+    """ Census numbers can have thousands separators, e.g. "1,038" """
+    return float(value.replace(',',''))
+
+def age_85(age):
+    """ Collapse a census age group (5 year, single year or open ended) to agecut5_85 """
+
+    if age.endswith('+'):
+        age = age[:-1]
+    age = int(age)
+
+    if age < 20:
+        return None
+    elif age >= 85:
+        return '85+'
+    else:
+        return str(age - age % 5)
+
+
+class Table:
+    """ A numpy array with named axes, and the labels along each axis """
+
+    def __init__(self, names, labels, values, year=None):
+        self.names = tuple(names)
+        self.labels = [list(axis_labels) for axis_labels in labels]
+        self.values = values
+        # Tables only for a single year (e.g. census) don't have a year axis
+        self.year = year
+
+    @classmethod
+    def from_rows(cls, names, rows, labels=None, year=None):
+        """ Sum (key tuple, value) rows into a table, keys with a None label are skipped """
+
+        rows = [(key, value) for key, value in rows if None not in key]
+
+        if labels is None:
+            labels = [sorted(set(key[i] for key, value in rows)) for i in xrange(len(names))]
+
+        index = [dict((label, i) for i, label in enumerate(axis_labels)) for axis_labels in labels]
+        values = numpy.zeros([len(axis_labels) for axis_labels in labels])
+
+        for key, value in rows:
+            try:
+                position = tuple(index[i][label] for i, label in enumerate(key))
+            except KeyError:
+                continue
+            values[position] += value
+
+        return cls(names, labels, values, year)
+
+    def axis_labels(self, name):
+        return self.labels[self.names.index(name)]
+
+    def select(self, axes):
+        """ Sum over any axes not listed, then order the remaining axes as listed
+
+        axes is a list of (name, labels). Labels that the table doesn't have are filled with 0.
+        """
+
+        values = self.values
+        names = list(self.names)
+        labels = list(self.labels)
+
+        for name in list(names):
+            if name not in [axis for axis, axis_labels in axes]:
+                i = names.index(name)
+                values = values.sum(axis=i)
+                del names[i]
+                del labels[i]
+
+        for name, axis_labels in axes:
+            i = names.index(name)
+            known = dict((label, j) for j, label in enumerate(labels[i]))
+            # Index one past the end for missing labels, which is a slice of zeros
+            position = [known.get(label, len(labels[i])) for label in axis_labels]
+            shape = list(values.shape)
+            shape[i] = 1
+            values = numpy.concatenate([values, numpy.zeros(shape)], axis=i).take(position, axis=i)
+            labels[i] = axis_labels
+
+        order = [names.index(name) for name, axis_labels in axes]
+        return values.transpose(order)
+
+
+def load_year_sex_age(fname='input/pop-by-year-sex-age5.csv'):
+    """ ERP by year, sex and age (85 and 90+ combined) """
+
+    # Saved with old Mac line endings
+    with open(fname, 'rU') as f:
+        rows = [((row['year'], row['sex'], age_85(row['agecut5_90'])), read_number(row['pop']))
+                for row in csv.DictReader(f)]
+
+    return Table.from_rows(('year','sex','age'), rows)
+
+def load_ethnicity_sex_age(fname='input/pop-by-ethnicity-age5-sex-2013.csv'):
+    """ 2013 ERP by ethnicity, sex and age (multiple counts) """
+
+    with open(fname, 'rU') as f:
+        rows = [((row['ethnicity'], row['sex'], row['agecut']), read_number(row['ethnicpoperp']))
+                for row in csv.DictReader(f)
+                # 85 and 90+ are also given combined as 85+
+                if row['agecut'] not in ('85','90+')]
+
+    ethnicities = ['European','Maori','Pacific','Asian','Other']
+    return Table.from_rows(('ethnicity','sex','age'), rows,
+                           labels=[ethnicities, ['F','M'], AGES_85], year='2013')
+
+def load_dhb_sex_age(fname='input/dhb-age-sex-2013.csv'):
+    """ 2013 ERP by DHB, sex and age """
+
+    with open(fname, 'rU') as f:
+        rows = [((row['dhb'], row['sex'], age_85(row['agecut'])), read_number(row['pop']))
+                for row in csv.DictReader(f)
+                if row['dhb'] != 'Total' and row['sex'] != 'All']
+
+    return Table.from_rows(('dhb','sex','age'), rows, year='2013')
+
+def load_dhb_ethnicity_sex_age(fname='input/dhb-ethnicity-age-sex-2013-processed.csv'):
+    """ 2013 census by DHB, ethnicity, sex and single year of age """
+
+    # Census ethnic groups to the groups used for dispensings (see PharmacData.ethnic_mapping)
+    ethnicities = {'European':'European',
+                   'Other':'European', # Primarily New Zealander
+                   'Maori':'Maori',
+                   'Pacific':'Pacific',
+                   'Asian':'Asian',
+                   'MELAA':'Other'}
+
+    rows = []
+    with open(fname, 'rU') as f:
+        for row in csv.DictReader(f):
+            if row['sex'] == 'Total' or row['age'] == 'Total':
+                continue
+            if row['dhb'] in ('Total New Zealand','Area outside dhb'):
+                continue
+            for column in ethnicities:
+                rows.append(((row['dhb'], ethnicities[column], row['sex'], age_85(row['age'])),
+                             read_number(row[column])))
+
+    return Table.from_rows(('dhb','ethnicity','sex','age'), rows, year='2013')
+
+def load_standard(standard='nz_standard_pop'):
+    """ Standard population weights by age (nz_standard_pop, who, segi or scandanavian),
+    or by sex and age (nz_standard_pop_sex) """
+
+    if standard == 'nz_standard_pop_sex':
+        fname, column, names = 'input/standard-pop-age-sex.csv', 'nz_standard_pop', ('sex','age')
+    else:
+        fname, column, names = 'input/standard-pop-age.csv', standard, ('age',)
+
+    rows = []
+    with open(fname, 'rU') as f:
+        for row in csv.DictReader(f):
+            # 85+ is given along with 85, 90, 95, 90+, 100+
+            if row['agecut'] in AGES_85 and row[column] != 'NA':
+                key = (row['sex'], row['agecut']) if 'sex' in names else (row['agecut'],)
+                rows.append((key, float(row[column])))
+
+    return Table.from_rows(names, rows)
+
+def load_nhi_corrections(fname='input/pop-by-year-nhi-percent.csv'):
+    """ Corrections by year for dispensings with a missing NHI
+
+    Prevalence is scaled up by the percentage of dispensings with an NHI. Some
+    apparently new cases are only due to the NHI no longer being missing, so
+    incidence is also scaled down by the fraction of newly recorded NHIs.
+    """
+
+    prevalence = dict()
+    incidence = dict()
+    with open(fname, 'rU') as f:
+        for row in csv.DictReader(f):
+            prevalence[row['year']] = 100/float(row['sample_totnhi'])
+            incidence[row['year']] = prevalence[row['year']]*(1 - float(row['sample_newnhi'])/100)
+
+    return {'prevalence':prevalence, 'incidence':incidence}
+
+def load_counts(fname='output/classification_counts.csv', measure='prevalence',
+                classifications=('Very probable','Probable')):
+    """ Counts of people by year, sex, ethnicity, DHB and age (agecut5_85) """
+
+    with open(fname, 'rU') as f:
+        rows = [((row['year'], row['sex'], row['ethnicity'], row['dhb'], row['agecut5_85']),
+                 int(row['n']))
+                for row in csv.DictReader(f)
+                if row['measure'] == measure and row['classification'] in classifications]
+
+    return Table.from_rows(('year','sex','ethnicity','dhb','age'), rows)
+
+
+class RateEngine:
+    """ Crude and directly standardised rates from counts and population tables """
+
+    def __init__(self):
+
+        self.populations = OrderedDict([
+                ('year_sex_age', load_year_sex_age()),
+                ('ethnicity_sex_age_2013', load_ethnicity_sex_age()),
+                ('dhb_sex_age_2013', load_dhb_sex_age()),
+                ('dhb_ethnicity_sex_age_2013', load_dhb_ethnicity_sex_age()),
+            ])
+
+        self.standards = dict()
+        self.nhi_corrections = load_nhi_corrections()
+
+    def standard(self, name):
+        if name not in self.standards:
+            self.standards[name] = load_standard(name)
+        return self.standards[name]
+
+    def corrected(self, counts, measure, by):
+        """ Apply the missing NHI, unmedicated and unknown ethnicity corrections to counts """
+
+        values = counts.values * UNMEDICATED_CORRECTION
+
+        # Years without a known missing rate are left uncorrected
+        factors = numpy.array([self.nhi_corrections[measure].get(year, 1.0)
+                               for year in counts.axis_labels('year')])
+        shape = [1]*len(counts.names)
+        shape[counts.names.index('year')] = len(factors)
+        values = values * factors.reshape(shape)
+
+        if 'ethnicity' in by:
+            values = values * UNKNOWN_ETHNICITY_CORRECTION
+
+        return Table(counts.names, counts.labels, values)
+
+    def rates(self, counts, by, population='year_sex_age', measure='prevalence',
+              standard='nz_standard_pop', correct=True):
+        """ Rates per 100,000 stratified by the axes in by
+
+        counts is a Table from load_counts. Rates are standardised over the
+        axes of the standard (age, or sex and age) that aren't in by.
+        Returns an OrderedDict with the labels of each stratum and arrays of
+        the cases, population, crude rate and standardised rate.
+        """
+
+        pop = self.populations[population]
+        weights = self.standard(standard)
+
+        for name in by:
+            if name not in pop.names and not (name == 'year' and pop.year):
+                raise ValueError("Population {} isn't split by {}".format(population, name))
+
+        # Populations only for one year can only be used with that year's counts
+        if pop.year:
+            if 'year' in by:
+                raise ValueError("Population {} is only for {}".format(population, pop.year))
+            labels = [[pop.year] if name == 'year' else counts.axis_labels(name) for name in counts.names]
+            counts = Table(counts.names, labels, counts.select(zip(counts.names, labels)))
+
+        if correct:
+            counts = self.corrected(counts, measure, by)
+
+        standardised_over = [name for name in weights.names if name not in by]
+
+        axes = [(name, pop.axis_labels(name)) for name in by]
+        axes += [(name, [label for label in pop.axis_labels(name) if label in weights.axis_labels(name)])
+                 for name in standardised_over]
+        std_axes = tuple(xrange(len(by), len(axes)))
+
+        cases = counts.select(axes)
+        population_values = pop.select(axes)
+
+        # Weights broadcast over the strata, and sum to one within each stratum
+        w = weights.select([(name, labels) for name, labels in axes if name in weights.names])
+        w = w.reshape([len(labels) if name in weights.names else 1 for name, labels in axes])
+        w = w / w.sum(axis=std_axes, keepdims=True)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            specific = numpy.where(population_values > 0, cases/population_values, 0.0)
+            total_cases = cases.sum(axis=std_axes)
+            total_population = population_values.sum(axis=std_axes)
+            crude = total_cases/total_population
+
+        standardised = (w*specific).sum(axis=std_axes)
+
+        return OrderedDict([('by', by),
+                            ('labels', [labels for name, labels in axes[:len(by)]]),
+                            ('cases', total_cases),
+                            ('population', total_population),
+                            ('crude', crude*TO_PER_100000),
+                            ('standardised', standardised*TO_PER_100000)])
+
+
+def write_rates(fname, results):
+    """ Write rates for several stratifications to one csv """
+
+    names = ['year','sex','ethnicity','dhb']
+    fields = ['measure','population','standard'] + names + ['cases','population_n','crude','standardised']
+
+    with open(fname, "w") as f:
+        writer = csv.DictWriter(f, fieldnames=fields, restval='All')
+        writer.writeheader()
+
+        for info, result in results:
+            for index in numpy.ndindex(*result['crude'].shape):
+                row = dict(info)
+                for i, name in enumerate(result['by']):
+                    row[name] = result['labels'][i][index[i]]
+                row['cases'] = "{:.1f}".format(result['cases'][index])
+                row['population_n'] = "{:.0f}".format(result['population'][index])
+                row['crude'] = "{:.2f}".format(result['crude'][index])
+                row['standardised'] = "{:.2f}".format(result['standardised'][index])
+                writer.writerow(row)
+
+
+def main(fname='output/rates.csv'):
+    """ Rates by year, year and sex, ethnicity (2013) and DHB (2013) """
+
+    engine = RateEngine()
+
+    results = []
+    for measure in ('prevalence','incidence'):
+        counts = load_counts(measure=measure)
+
+        for by, population in ((('year',), 'year_sex_age'),
+                               (('year','sex'), 'year_sex_age'),
+                               (('ethnicity',), 'ethnicity_sex_age_2013'),
+                               (('dhb',), 'dhb_sex_age_2013')):
+            result = engine.rates(counts, by, population, measure)
+            results.append(({'measure':measure, 'population':population, 'standard':'nz_standard_pop'},
+                            result))
+
+    write_rates(fname, results)
+
+
+if __name__ == '__main__':
+
+    main()
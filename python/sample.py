@@ -0,0 +1,64 @@
+""" Deterministic sampling of people by NHI, for quick development runs
+
+An NHI is kept when a hash of it falls below the sampling fraction. The
+hash doesn't depend on the file, the order of records or the process, so
+every stage (pharmacdata.py, nmds.py, diagnoses.py and process.py) keeps
+the same people and keeps all of their records.
+
+    python pharmacdata.py --sample 0.01
+    python pipeline.py --sample 0.01
+"""
+import hashlib
+import numpy
+
+# Fraction of people kept, None keeps everyone
+fraction = None
+
+kept = dict()
+
+def set_fraction(value):
+    """ Set the fraction of people kept, None (or 1) for everyone """
+
+    global fraction
+
+    if value is not None and not 0 < value <= 1:
+        raise ValueError("Sample fraction must be between 0 and 1, not {}".format(value))
+
+    fraction = None if value in (None, 1) else value
+    kept.clear()
+
+def unit_hash(nhi):
+    """ Stable value in [0,1) for an NHI """
+    return int(hashlib.md5(nhi.strip().upper()).hexdigest()[:8], 16)/float(1 << 32)
+
+def keep(nhi):
+    """ True if the person with this NHI is in the sample """
+
+    if fraction is None:
+        return True
+
+    try:
+        return kept[nhi]
+    except KeyError:
+        kept[nhi] = unit_hash(nhi) < fraction
+        return kept[nhi]
+
+def keep_array(nhis):
+    """ Boolean array of which NHIs in a numpy array are in the sample """
+
+    if fraction is None:
+        return numpy.ones(nhis.shape, dtype=bool)
+
+    uniq, inverse = numpy.unique(nhis, return_inverse=True)
+    return numpy.array([keep(nhi) for nhi in uniq.tolist()], dtype=bool)[inverse].reshape(nhis.shape)
+
+
+def add_argument(parser):
+    """ Add --sample to a script's arguments """
+    parser.add_argument('--sample', type=float, default=None, metavar='FRACTION',
+                        help='Only include this fraction of people, chosen by a hash of their NHI')
+
+def from_arguments(args):
+    set_fraction(args.sample)
+    if fraction is not None:
+        print "Sampling {:g}% of people by NHI".format(fraction*100)